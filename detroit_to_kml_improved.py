@@ -6,32 +6,154 @@ Better coordinate transformation based on actual data analysis.
 """
 
 import json
-import simplekml
+import os
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack, contextmanager
+from functools import lru_cache
 from pathlib import Path
 import math
+from xml.sax.saxutils import escape
+import numpy as np
 
-def analyze_coordinate_statistics(map_file):
-    """Analyze the coordinate statistics to understand the data better."""
+try:
+    import orjson  # Much faster decode for multi-MB map files
+except ImportError:
+    orjson = None
+
+try:
+    import ijson  # Incremental parser for map files too large to load whole
+except ImportError:
+    ijson = None
+
+# Map files at least this large are parsed incrementally with ijson (when installed)
+STREAMING_PARSE_MIN_BYTES = 256 * 1024 * 1024
+
+# Reference point and scale factors (meters to degrees) for the improved transform.
+# Known Detroit locations for reference: Downtown Detroit ~42.3314° N, 83.0458° W
+REFERENCE_LAT = 42.3314  # Detroit downtown area
+REFERENCE_LON = -83.0458
+METERS_PER_DEGREE_LAT = 111320.0  # ~111.32 km per degree latitude
+LAT_SCALE = 1.0 / METERS_PER_DEGREE_LAT
+
+@lru_cache(maxsize=8)
+def _lon_scale(ref_lat):
+    """Meters-to-degrees longitude scale at a reference latitude (computed once per latitude)."""
+    return 1.0 / (METERS_PER_DEGREE_LAT * math.cos(math.radians(ref_lat)))
+
+LON_SCALE = _lon_scale(REFERENCE_LAT)
+
+# KML colors (aabbggrr) used by the directly emitted documents
+KML_BLUE_ALPHA_150 = '96ff0000'
+KML_GREEN_ALPHA_120 = '78008000'
+KML_RED = 'ff0000ff'
+KML_YELLOW = 'ff00ffff'
+LANDMARK_ICON_HREF = 'http://maps.google.com/mapfiles/kml/pushpin/grn-pushpin.png'
+LANDMARK_STYLE = (
+    f'<Style id="landmark"><IconStyle><scale>1.2</scale>'
+    f'<Icon><href>{LANDMARK_ICON_HREF}</href></Icon></IconStyle></Style>\n'
+)
+
+# Detroit landmarks for reference: (name, lat, lon)
+DETROIT_LANDMARKS = [
+    ("Detroit Downtown", 42.3314, -83.0458),
+    ("Detroit Metro Airport", 42.2124, -83.3534),
+    ("Belle Isle", 42.3401, -82.9851),
+    ("Ford Field", 42.3400, -83.0456)
+]
+
+KML_HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n<kml xmlns="http://www.opengis.net/kml/2.2">\n<Document>\n'
+KML_FOOTER = '</Document>\n</kml>\n'
+
+def _load_areas_soa(map_file):
+    """
+    Load drivable areas into flat offset + column arrays.
+    
+    The JSON is parsed once and each boundary point dict is touched once.
+    Returns a dict with:
+        - 'area_ids': list of area IDs
+        - 'offsets': int64 array of length n_areas + 1; area i owns
+          xs/ys[offsets[i]:offsets[i + 1]]
+        - 'xs', 'ys': contiguous float64 arrays of every boundary point
+    
+    Very large files are parsed incrementally (see _stream_areas_soa).
+    """
+    
+    if ijson is not None and os.path.getsize(map_file) >= STREAMING_PARSE_MIN_BYTES:
+        return _stream_areas_soa(map_file)
     
-    with open(map_file, 'r') as f:
-        map_data = json.load(f)
+    map_bytes = Path(map_file).read_bytes()
+    map_data = orjson.loads(map_bytes) if orjson else json.loads(map_bytes)
     
     drivable_areas = map_data.get('drivable_areas', {})
     
-    all_x = []
-    all_y = []
+    area_ids = list(drivable_areas.keys())
+    boundaries = [area_data.get('area_boundary', []) for area_data in drivable_areas.values()]
+    
+    offsets = np.zeros(len(boundaries) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in boundaries], out=offsets[1:])
+    
+    # Fill exactly-sized column buffers (fromiter with count preallocates)
+    n_points = int(offsets[-1])
+    xs = np.fromiter((p['x'] for b in boundaries for p in b), dtype=np.float64, count=n_points)
+    ys = np.fromiter((p['y'] for b in boundaries for p in b), dtype=np.float64, count=n_points)
+    
+    return {'area_ids': area_ids, 'offsets': offsets, 'xs': xs, 'ys': ys}
+
+def _stream_areas_soa(map_file):
+    """
+    Incremental variant of _load_areas_soa built on ijson.
+    
+    Drivable areas are decoded one at a time and their points appended to
+    compact float64 buffers, so the full JSON tree is never materialized;
+    peak memory is the column buffers plus the area being parsed.
+    """
+    
+    area_ids = []
+    counts = []
+    xs = array('d')
+    ys = array('d')
+    
+    with open(map_file, 'rb') as f:
+        for area_id, area_data in ijson.kvitems(f, 'drivable_areas', use_float=True):
+            boundary_points = area_data.get('area_boundary', [])
+            area_ids.append(area_id)
+            counts.append(len(boundary_points))
+            xs.extend(p['x'] for p in boundary_points)
+            ys.extend(p['y'] for p in boundary_points)
+    
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    
+    return {
+        'area_ids': area_ids,
+        'offsets': offsets,
+        'xs': np.frombuffer(xs, dtype=np.float64),
+        'ys': np.frombuffer(ys, dtype=np.float64)
+    }
+
+def analyze_coordinate_statistics(areas_or_file):
+    """
+    Analyze the coordinate statistics to understand the data better.
+    
+    Accepts either the already loaded areas from _load_areas_soa or a map file
+    path, so callers that have parsed the map don't parse it again.
+    """
+    
+    areas = areas_or_file if isinstance(areas_or_file, dict) else _load_areas_soa(areas_or_file)
     
-    for area_data in drivable_areas.values():
-        boundary_points = area_data.get('area_boundary', [])
-        for point in boundary_points:
-            all_x.append(point['x'])
-            all_y.append(point['y'])
+    xs = areas['xs']
+    ys = areas['ys']
+    n_points = len(xs)
+    
+    x_min, x_max, x_sum = float(xs.min()), float(xs.max()), float(xs.sum())
+    y_min, y_max, y_sum = float(ys.min()), float(ys.max()), float(ys.sum())
     
     stats = {
-        'x_min': min(all_x), 'x_max': max(all_x), 'x_center': sum(all_x) / len(all_x),
-        'y_min': min(all_y), 'y_max': max(all_y), 'y_center': sum(all_y) / len(all_y),
-        'x_span': max(all_x) - min(all_x),
-        'y_span': max(all_y) - min(all_y)
+        'x_min': x_min, 'x_max': x_max, 'x_center': x_sum / n_points,
+        'y_min': y_min, 'y_max': y_max, 'y_center': y_sum / n_points,
+        'x_span': x_max - x_min,
+        'y_span': y_max - y_min
     }
     
     print(f"📊 Coordinate Statistics:")
@@ -46,63 +168,107 @@ def coordinate_transform_improved(x, y, stats):
     
     Strategy: Map the center of our data to a known Detroit location,
     then scale appropriately.
-    """
     
-    # Known Detroit locations for reference:
-    # Downtown Detroit: ~42.3314° N, 83.0458° W
-    # Let's assume our data center corresponds to a Detroit area
+    Accepts scalars or NumPy arrays; arrays are transformed in a single
+    vectorized pass.
+    """
     
     # Use the actual center of our data as the reference point
     local_center_x = stats['x_center']  # ~10125m
     local_center_y = stats['y_center']  # ~3540m
     
-    # Map to a reasonable Detroit location (adjust as needed)
-    # This is still approximate but more realistic
-    reference_lat = 42.3314  # Detroit downtown area
-    reference_lon = -83.0458
-    
-    # Scale factors (meters to degrees)
-    lat_scale = 1.0 / 111320  # ~111.32 km per degree latitude
-    lon_scale = 1.0 / (111320 * math.cos(math.radians(reference_lat)))
-    
     # Transform relative to the center
     dx = x - local_center_x  # Offset from center in meters
     dy = y - local_center_y  # Offset from center in meters
     
     # Convert to lat/lon
-    lat = reference_lat + dy * lat_scale
-    lon = reference_lon + dx * lon_scale
+    lat = REFERENCE_LAT + dy * LAT_SCALE
+    lon = REFERENCE_LON + dx * LON_SCALE
     
     return lat, lon
 
-def create_detroit_kml_improved(map_file, output_file="detroit_drivable_areas_improved.kml"):
-    """Create improved KML file with better coordinate transformation."""
-    
-    print(f" Creating improved KML from Detroit data...")
+@contextmanager
+def _kml_stream(output_file, name, description=None):
+    """
+    Open a KML document for streaming output.
     
-    if not Path(map_file).exists():
-        print(f"Map file not found: {map_file}")
-        return None
+    The header is written on entry and the closing tags on exit, so features
+    can be written one at a time without holding the document in memory.
+    """
+    with open(output_file, 'w', encoding='utf-8', buffering=1 << 20) as out:
+        out.write(KML_HEADER)
+        out.write(f'<name>{escape(name)}</name>\n')
+        if description is not None:
+            out.write(f'<description>{escape(description)}</description>\n')
+        yield out
+        out.write(KML_FOOTER)
+
+def _polygon_style(style_id, poly_color, line_color, line_width):
+    """Return a shared polygon <Style> block that placemarks reference by styleUrl."""
+    return (
+        f'<Style id="{style_id}">'
+        f'<LineStyle><color>{line_color}</color><width>{line_width}</width></LineStyle>'
+        f'<PolyStyle><color>{poly_color}</color><outline>1</outline></PolyStyle>'
+        f'</Style>\n'
+    )
+
+# Shared polygon styles, built once; placemarks reference them by id
+DRIVABLE_AREA_STYLE = _polygon_style('drivable_area', KML_BLUE_ALPHA_150, KML_RED, 3)
+ATTEMPT_AREA_STYLE = _polygon_style('attempt_area', KML_GREEN_ALPHA_120, KML_YELLOW, 2)
+
+def _emit_polygon(out, name, lon, lat, style_id, description=None):
+    """Write one closed polygon Placemark straight to the output stream."""
+    out.write(f'<Placemark><name>{escape(name)}</name>')
+    if description is not None:
+        out.write(f'<description>{escape(description)}</description>')
+    
+    # Build the closed ring (first vertex repeated at the end) in one preallocated array
+    n = len(lon)
+    ring = np.empty((n + 1, 2), dtype=np.float64)
+    ring[:n, 0] = lon
+    ring[:n, 1] = lat
+    ring[n] = ring[0]
+    
+    # Format every vertex with a single %-operation instead of one f-string per point
+    coordinates = ('%.7f,%.7f,0 ' * (n + 1)) % tuple(ring.ravel().tolist())
+    
+    out.write(f'<styleUrl>#{style_id}</styleUrl><Polygon><outerBoundaryIs><LinearRing><coordinates>')
+    out.write(coordinates[:-1])
+    out.write('</coordinates></LinearRing></outerBoundaryIs></Polygon></Placemark>\n')
+
+def create_detroit_kml_improved(map_file, output_file="detroit_drivable_areas_improved.kml", areas=None, stats=None):
+    """
+    Create improved KML file with better coordinate transformation.
     
-    # First, analyze the coordinate statistics
-    stats = analyze_coordinate_statistics(map_file)
+    Pass already loaded `areas` (and `stats`) to reuse a previous parse of map_file.
+    """
     
-    # Load Detroit map data
-    with open(map_file, 'r') as f:
-        map_data = json.load(f)
+    print(f" Creating improved KML from Detroit data...")
     
-    drivable_areas = map_data.get('drivable_areas', {})
+    if areas is None:
+        if not Path(map_file).exists():
+            print(f"Map file not found: {map_file}")
+            return None
+        
+        # Load Detroit map data
+        areas = _load_areas_soa(map_file)
     
-    if not drivable_areas:
+    if not areas['area_ids']:
         print("No drivable areas found in map data")
         return None
     
-    print(f"📊 Processing {len(drivable_areas)} drivable areas with improved transformation...")
+    # First, analyze the coordinate statistics
+    if stats is None:
+        stats = analyze_coordinate_statistics(areas)
+    
+    area_ids = areas['area_ids']
+    offsets = areas['offsets']
+    xs = areas['xs']
+    ys = areas['ys']
+    
+    print(f"📊 Processing {len(area_ids)} drivable areas with improved transformation...")
     
-    # Create KML document
-    kml = simplekml.Kml()
-    kml.document.name = "Detroit Drivable Areas - Improved Transform"
-    kml.document.description = f"""
+    description = f"""
     Detroit drivable areas with improved coordinate transformation.
     
     Dataset: Argoverse 2 Sensor Dataset
@@ -114,83 +280,73 @@ def create_detroit_kml_improved(map_file, output_file="detroit_drivable_areas_im
     Data Span: {stats['x_span']:.1f}m × {stats['y_span']:.1f}m
     """
     
-    # Create folder for drivable areas
-    folder = kml.newfolder(name="Drivable Areas")
+    # Convert every boundary point in one vectorized pass, then slice per area
+    all_lat, all_lon = coordinate_transform_improved(xs, ys, stats)
     
-    # Process each drivable area
-    for i, (area_id, area_data) in enumerate(drivable_areas.items()):
-        boundary_points = area_data.get('area_boundary', [])
-        
-        if len(boundary_points) < 3:
-            continue
-        
-        print(f"   Processing area {i+1}/{len(drivable_areas)} (ID: {area_id}, {len(boundary_points)} points)")
-        
-        # Convert coordinates using improved transformation
-        coords = []
-        for point in boundary_points:
-            lat, lon = coordinate_transform_improved(point['x'], point['y'], stats)
-            coords.append((lon, lat, 0))
-        
-        # Close the polygon
-        coords.append(coords[0])
-        
-        # Create polygon
-        pol = folder.newpolygon(name=f"Area {area_id}")
-        pol.outerboundaryis = coords
-        
-        # Style - make them more visible
-        pol.style.polystyle.color = simplekml.Color.changealphaint(150, simplekml.Color.blue)
-        pol.style.polystyle.outline = 1
-        pol.style.linestyle.color = simplekml.Color.red
-        pol.style.linestyle.width = 3
+    # Stream the KML feature by feature; every polygon references one shared style
+    with _kml_stream(output_file, "Detroit Drivable Areas - Improved Transform", description) as out:
+        out.write(DRIVABLE_AREA_STYLE)
+        out.write(LANDMARK_STYLE)
         
-        # Add description with coordinate info
-        center_x = sum(pt['x'] for pt in boundary_points) / len(boundary_points)
-        center_y = sum(pt['y'] for pt in boundary_points) / len(boundary_points)
-        center_lat, center_lon = coordinate_transform_improved(center_x, center_y, stats)
+        # Create folder for drivable areas
+        out.write('<Folder><name>Drivable Areas</name>\n')
         
-        pol.description = f"""
+        # Process each drivable area
+        for i, area_id in enumerate(area_ids):
+            start, end = offsets[i], offsets[i + 1]
+            if end - start < 3:
+                continue
+            
+            n_area_points = end - start
+            lat = all_lat[start:end]
+            lon = all_lon[start:end]
+            
+            print(f"   Processing area {i+1}/{len(area_ids)} (ID: {area_id}, {n_area_points} points)")
+            
+            # Add description with coordinate info; the transform is affine, so the
+            # transformed centroid is just the mean of the transformed ring
+            center_x = xs[start:end].mean()
+            center_y = ys[start:end].mean()
+            center_lat = lat.mean()
+            center_lon = lon.mean()
+            
+            area_description = f"""
         Area ID: {area_id}
-        Points: {len(boundary_points)}
+        Points: {n_area_points}
         Local Center: ({center_x:.1f}, {center_y:.1f})
         Transformed: ({center_lat:.6f}, {center_lon:.6f})
         """
+            
+            _emit_polygon(out, f"Area {area_id}", lon, lat, 'drivable_area', area_description)
+        
+        out.write('</Folder>\n')
+        
+        # Add reference points for known Detroit locations, all sharing one icon style
+        out.write('<Folder><name>Reference Points</name>\n')
+        out.write(''.join(
+            f'<Placemark><name>{escape(name)}</name><styleUrl>#landmark</styleUrl>'
+            f'<Point><coordinates>{lon},{lat},0</coordinates></Point></Placemark>\n'
+            for name, lat, lon in DETROIT_LANDMARKS
+        ))
+        out.write('</Folder>\n')
     
-    # Add reference points for known Detroit locations
-    ref_folder = kml.newfolder(name="Reference Points")
-    
-    # Detroit landmarks for reference
-    landmarks = [
-        ("Detroit Downtown", 42.3314, -83.0458),
-        ("Detroit Metro Airport", 42.2124, -83.3534),
-        ("Belle Isle", 42.3401, -82.9851),
-        ("Ford Field", 42.3400, -83.0456)
-    ]
-    
-    for name, lat, lon in landmarks:
-        pnt = ref_folder.newpoint(name=name)
-        pnt.coords = [(lon, lat)]
-        pnt.style.iconstyle.icon.href = 'http://maps.google.com/mapfiles/kml/pushpin/grn-pushpin.png'
-        pnt.style.iconstyle.scale = 1.2
-    
-    # Save KML file
-    kml.save(output_file)
     print(f"✅ Improved KML file created: {output_file}")
     
     return output_file
 
-def create_multiple_transformation_attempts(map_file):
-    """Create multiple KML files with different transformation approaches."""
-    
-    print(f"\nCreating multiple transformation attempts...")
+def create_multiple_transformation_attempts(map_file, areas=None, stats=None):
+    """
+    Create multiple KML files with different transformation approaches.
     
-    stats = analyze_coordinate_statistics(map_file)
+    Pass already loaded `areas` (and `stats`) to reuse a previous parse of map_file.
+    """
     
-    with open(map_file, 'r') as f:
-        map_data = json.load(f)
+    print(f"\nCreating multiple transformation attempts...")
     
-    drivable_areas = map_data.get('drivable_areas', {})
+    if areas is None:
+        areas = _load_areas_soa(map_file)
+    if stats is None:
+        stats = analyze_coordinate_statistics(areas)
     
     # Different transformation approaches
     transforms = [
@@ -211,42 +367,45 @@ def create_multiple_transformation_attempts(map_file):
         }
     ]
     
-    for transform in transforms:
-        output_file = f"detroit_attempt_{transform['name']}.kml"
-        
-        kml = simplekml.Kml()
-        kml.document.name = f"Detroit Areas - {transform['description']}"
-        
-        folder = kml.newfolder(name="Drivable Areas")
+    area_ids = areas['area_ids']
+    offsets = areas['offsets']
+    
+    # Offsets from the data center are shared by every attempt
+    dx = areas['xs'] - stats['x_center']
+    dy = areas['ys'] - stats['y_center']
+    
+    # Compute every attempt in one fused pass: (n_transforms, N) lat/lon via broadcasting
+    ref_lats = np.array([transform['ref_lat'] for transform in transforms])
+    ref_lons = np.array([transform['ref_lon'] for transform in transforms])
+    lon_scales = np.array([_lon_scale(transform['ref_lat']) for transform in transforms])
+    
+    all_lats = ref_lats[:, None] + dy[None, :] * LAT_SCALE
+    all_lons = ref_lons[:, None] + dx[None, :] * lon_scales[:, None]
+    
+    output_files = [f"detroit_attempt_{transform['name']}.kml" for transform in transforms]
+    
+    # Open every attempt at once and fan each area out to all of them in one pass
+    with ExitStack() as stack:
+        outs = []
+        for transform, output_file in zip(transforms, output_files):
+            out = stack.enter_context(_kml_stream(output_file, f"Detroit Areas - {transform['description']}"))
+            out.write(ATTEMPT_AREA_STYLE)
+            out.write('<Folder><name>Drivable Areas</name>\n')
+            outs.append(out)
         
-        for area_id, area_data in drivable_areas.items():
-            boundary_points = area_data.get('area_boundary', [])
-            if len(boundary_points) < 3:
+        for i, area_id in enumerate(area_ids):
+            start, end = offsets[i], offsets[i + 1]
+            if end - start < 3:
                 continue
             
-            coords = []
-            for point in boundary_points:
-                # Custom transformation for this attempt
-                dx = point['x'] - stats['x_center']
-                dy = point['y'] - stats['y_center']
-                
-                lat_scale = 1.0 / 111320
-                lon_scale = 1.0 / (111320 * math.cos(math.radians(transform['ref_lat'])))
-                
-                lat = transform['ref_lat'] + dy * lat_scale
-                lon = transform['ref_lon'] + dx * lon_scale
-                
-                coords.append((lon, lat, 0))
-            
-            coords.append(coords[0])
-            
-            pol = folder.newpolygon(name=f"Area {area_id}")
-            pol.outerboundaryis = coords
-            pol.style.polystyle.color = simplekml.Color.changealphaint(120, simplekml.Color.green)
-            pol.style.linestyle.color = simplekml.Color.yellow
-            pol.style.linestyle.width = 2
+            name = f"Area {area_id}"
+            for out, all_lat, all_lon in zip(outs, all_lats, all_lons):
+                _emit_polygon(out, name, all_lon[start:end], all_lat[start:end], 'attempt_area')
         
-        kml.save(output_file)
+        for out in outs:
+            out.write('</Folder>\n')
+    
+    for output_file in output_files:
         print(f"   Created: {output_file}")
     
     print(f"\n💡 Try opening each file in Google Earth to see which looks most realistic!")
@@ -263,11 +422,26 @@ def main():
         print(f"Detroit map file not found: {map_file}")
         return
     
-    # Create improved version
-    output_file = create_detroit_kml_improved(map_file)
+    # Parse the map once and share it between every KML build
+    areas = _load_areas_soa(map_file)
     
-    # Create multiple attempts with different reference points
-    create_multiple_transformation_attempts(map_file)
+    if not areas['area_ids']:
+        print("No drivable areas found in map data")
+        return
+    
+    stats = analyze_coordinate_statistics(areas)
+    
+    # The builds are independent and CPU-bound (XML serialization), so run them
+    # in separate processes; the column arrays pickle cheaply
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        # Create improved version
+        improved = executor.submit(create_detroit_kml_improved, map_file, areas=areas, stats=stats)
+        
+        # Create multiple attempts with different reference points
+        attempts = executor.submit(create_multiple_transformation_attempts, map_file, areas=areas, stats=stats)
+        
+        output_file = improved.result()
+        attempts.result()
     
     print(f"\n Created multiple KML files with different transformations!")
     print(f"📱 Try each one in Google Earth:")
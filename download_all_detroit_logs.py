@@ -4,16 +4,35 @@ Download All Detroit Logs
 
 Download all Detroit (DTW) logs from train, val, and test splits.
 Organize them in a structured directory format.
+
+S3 listing and downloads run concurrently on one asyncio event loop using
+aioboto3 with anonymous (unsigned) requests.
 """
 
-import subprocess
-import re
+import asyncio
 import json
 import os
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor, as_completed
 import time
 
+import aioboto3
+from botocore import UNSIGNED
+from botocore.config import Config
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+S3_BUCKET = 'argoverse'
+SENSOR_PREFIX = 'datasets/av2/sensor'
+
+# Public bucket: unsigned requests, one shared connection pool for all concurrent calls
+S3_CONFIG = Config(signature_version=UNSIGNED, max_pool_connections=200, retries={'max_attempts': 5})
+
+# Per-file cap for one log file download (sensor logs run to hundreds of MB); a stalled transfer fails instead of hanging the run
+DOWNLOAD_TIMEOUT_SECONDS = 300
+
 class DetroitLogDownloader:
     def __init__(self, base_dir="detroit_logs"):
         self.base_dir = Path(base_dir)
@@ -24,72 +43,78 @@ class DetroitLogDownloader:
             (self.base_dir / split).mkdir(exist_ok=True)
         
         self.found_logs = {'train': [], 'val': [], 'test': []}
+        self.detroit_map_files = {'train': {}, 'val': {}, 'test': {}}  # log_id -> DTW map archive filename
         self.download_stats = {'downloaded': 0, 'failed': 0, 'skipped': 0}
     
-    def find_detroit_logs_in_split(self, split):
+    async def find_map_file(self, s3, split, log_id):
+        """Return the DTW map archive filename for a log, or None if it isn't a Detroit log."""
+        
+        response = await s3.list_objects_v2(Bucket=S3_BUCKET, Prefix=f"{SENSOR_PREFIX}/{split}/{log_id}/map/")
+        for obj in response.get('Contents', []):
+            filename = obj['Key'].rsplit('/', 1)[-1]
+            if 'log_map_archive' in filename and 'DTW' in filename:
+                return filename
+        return None
+    
+    async def find_detroit_logs_in_split(self, s3, split, max_concurrency=64):
         """Find all Detroit logs in a specific split."""
         
         print(f"\n🔍 Searching for Detroit logs in {split} split...")
         
-        # Strategy: Sample logs to find Detroit ones
-        # Get list of all logs first
-        print(f"   Getting log list for {split}...")
-        
         try:
-            cmd = f"aws s3 ls --no-sign-request s3://argoverse/datasets/av2/sensor/{split}/"
-            result = subprocess.run(cmd, shell=True, capture_output=True, text=True, timeout=120)
-            
-            if result.returncode != 0:
-                print(f"   ❌ Failed to list logs in {split}")
-                return []
-            
-            # Extract log IDs
-            log_ids = [] 
-            for line in result.stdout.strip().split('\n'):
-                if 'PRE' in line:
-                    # Extract UUID from "PRE uuid/"
-                    match = re.search(r'PRE\s+([a-f0-9-]+)/', line)
-                    if match:
-                        log_ids.append(match.group(1))
+            # Get list of all logs first
+            print(f"   Getting log list for {split}...")
+            log_ids = []
+            paginator = s3.get_paginator('list_objects_v2')
+            async for page in paginator.paginate(Bucket=S3_BUCKET, Prefix=f"{SENSOR_PREFIX}/{split}/", Delimiter='/'):
+                for prefix in page.get('CommonPrefixes', []):
+                    # Extract UUID from ".../{split}/uuid/"
+                    log_ids.append(prefix['Prefix'].rstrip('/').rsplit('/', 1)[-1])
             
             print(f"   Found {len(log_ids)} total logs in {split}")
+            print(f"   Checking map data of all {len(log_ids)} logs concurrently...")
             
-            # Sample logs to check for Detroit data (checking all would be too slow)
-            sample_size =100000000  # Check first 50 logs
-            print(f"   Sampling {sample_size} logs to find Detroit data...")
+            # Check every log's map directory concurrently, bounded by a semaphore
+            semaphore = asyncio.Semaphore(max_concurrency)
             
-            detroit_logs = []
+            async def check_log(log_id):
+                async with semaphore:
+                    try:
+                        return log_id, await self.find_map_file(s3, split, log_id)
+                    except Exception as e:
+                        print(f"   ⚠️  Failed to check {split}/{log_id}: {e}")
+                        return log_id, None
             
-            for i, log_id in enumerate(log_ids):
-                if i % 10 == 0:
-                    print(f"   Checking log {i+1}/{sample_size}...")
-                
-                # Check if this log has Detroit map data
-                map_cmd = f"aws s3 ls --no-sign-request s3://argoverse/datasets/av2/sensor/{split}/{log_id}/map/ | grep DTW"
-                map_result = subprocess.run(map_cmd, shell=True, capture_output=True, text=True, timeout=30)
-                
-                if map_result.returncode == 0 and map_result.stdout.strip():
+            detroit_logs = []
+            results = await asyncio.gather(*(check_log(log_id) for log_id in log_ids))
+            for log_id, filename in results:
+                if filename:
                     detroit_logs.append(log_id)
+                    self.detroit_map_files[split][log_id] = filename
                     print(f"   ✅ Found Detroit log: {log_id}")
             
-            print(f"   🎯 Found {len(detroit_logs)} Detroit logs in {split} (from {sample_size} sampled)")
+            print(f"   🎯 Found {len(detroit_logs)} Detroit logs in {split} (from {len(log_ids)} checked)")
             return detroit_logs
             
-        except subprocess.TimeoutExpired:
-            print(f"   ⏰ Timeout while searching {split}")
-            return []
         except Exception as e:
             print(f"   ❌ Error searching {split}: {e}")
             return []
     
+    async def _find_all_detroit_logs(self, splits):
+        """Search all splits concurrently over one shared S3 client."""
+        session = aioboto3.Session()
+        async with session.client('s3', config=S3_CONFIG) as s3:
+            results = await asyncio.gather(*(self.find_detroit_logs_in_split(s3, split) for split in splits))
+        for split, logs in zip(splits, results):
+            self.found_logs[split] = logs
+    
     def find_all_detroit_logs(self):
         """Find Detroit logs across all splits."""
         
         print("🚗 Finding Detroit Logs Across All Splits")
         print("=" * 50)
         
-        for split in ['test', 'val', 'train']:  # Start with smaller splits
-            self.found_logs[split] = self.find_detroit_logs_in_split(split)
+        asyncio.run(self._find_all_detroit_logs(['test', 'val', 'train']))
         
         total_found = sum(len(logs) for logs in self.found_logs.values())
         print(f"\n📊 DISCOVERY SUMMARY:")
@@ -99,7 +124,7 @@ class DetroitLogDownloader:
         
         return total_found > 0
     
-    def download_log_data(self, split, log_id):
+    async def download_log_data(self, s3, semaphore, split, log_id):
         """Download essential data for a single Detroit log."""
         
         log_dir = self.base_dir / split / log_id
@@ -114,28 +139,25 @@ class DetroitLogDownloader:
         ]
         
         # Find and download the Detroit map file
-        try:
-            # List map files to find the DTW one
-            map_cmd = f"aws s3 ls --no-sign-request s3://argoverse/datasets/av2/sensor/{split}/{log_id}/map/"
-            map_result = subprocess.run(map_cmd, shell=True, capture_output=True, text=True, timeout=30)
-            
-            if map_result.returncode == 0:
-                for line in map_result.stdout.strip().split('\n'):
-                    if 'log_map_archive' in line and 'DTW' in line:
-                        filename = line.split()[-1]
-                        files_to_download.append({
-                            'name': 'map',
-                            'path': f'{log_id}/map/{filename}',
-                            'local': log_dir / f'map_{filename}'
-                        })
-                        break
-        except:
-            pass
+        # (usually already located during discovery)
+        filename = self.detroit_map_files[split].get(log_id)
+        if filename is None:
+            try:
+                async with semaphore:
+                    filename = await self.find_map_file(s3, split, log_id)
+            except Exception:
+                filename = None
+        if filename:
+            files_to_download.append({
+                'name': 'map',
+                'path': f'{log_id}/map/{filename}',
+                'local': log_dir / f'map_{filename}'
+            })
         
         # Download each file
         downloaded = 0
         for file_info in files_to_download:
-            s3_path = f"s3://argoverse/datasets/av2/sensor/{split}/{file_info['path']}"
+            key = f"{SENSOR_PREFIX}/{split}/{file_info['path']}"
             local_path = file_info['local']
             
             if local_path.exists():
@@ -143,44 +165,32 @@ class DetroitLogDownloader:
                 downloaded += 1
                 continue
             
+            # Download to a temporary name so a failed or timed-out transfer never leaves a
+            # partial file that later runs would skip as "already exists"
+            part_path = local_path.with_name(local_path.name + '.part')
             try:
-                cmd = f"aws s3 cp --no-sign-request {s3_path} {local_path}"
-                result = subprocess.run(cmd, shell=True, timeout=300)  # 5 min timeout
+                async with semaphore:
+                    await asyncio.wait_for(s3.download_file(S3_BUCKET, key, str(part_path)), timeout=DOWNLOAD_TIMEOUT_SECONDS)
+                part_path.replace(local_path)
                 
-                if result.returncode == 0 and local_path.exists():
-                    print(f"      ✅ Downloaded {file_info['name']}")
-                    downloaded += 1
-                else:
-                    print(f"      ❌ Failed to download {file_info['name']}")
+                print(f"      ✅ Downloaded {file_info['name']}")
+                downloaded += 1
                     
-            except subprocess.TimeoutExpired:
-                print(f"      ⏰ Timeout downloading {file_info['name']}")
             except Exception as e:
-                print(f"      ❌ Error downloading {file_info['name']}: {e}")
+                part_path.unlink(missing_ok=True)
+                print(f"      ❌ Error downloading {file_info['name']}: {type(e).__name__}: {e}")
         
         return downloaded > 0
     
-    def download_all_detroit_data(self, max_workers=3):
-        """Download data for all found Detroit logs."""
-        
-        all_downloads = []
-        for split, log_ids in self.found_logs.items():
-            for log_id in log_ids:
-                all_downloads.append((split, log_id))
-        
-        if not all_downloads:
-            print("❌ No Detroit logs to download")
-            return
+    async def _download_all_detroit_data(self, all_downloads, max_workers):
+        """Download all logs concurrently, with at most max_workers S3 requests in flight."""
+        semaphore = asyncio.Semaphore(max_workers)
         
-        print(f"\n📥 Downloading data for {len(all_downloads)} Detroit logs...")
-        print(f"Using {max_workers} parallel downloads")
-        
-        def download_worker(split_log):
-            split, log_id = split_log
+        async def download_worker(split, log_id):
             print(f"   📦 Downloading {split}/{log_id[:8]}...")
             
             try:
-                success = self.download_log_data(split, log_id)
+                success = await self.download_log_data(s3, semaphore, split, log_id)
                 if success:
                     self.download_stats['downloaded'] += 1
                     return f"✅ {split}/{log_id[:8]}"
@@ -191,14 +201,29 @@ class DetroitLogDownloader:
                 self.download_stats['failed'] += 1
                 return f"💥 {split}/{log_id[:8]}: {e}"
         
-        # Download with thread pool
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            future_to_log = {executor.submit(download_worker, dl): dl for dl in all_downloads}
-            
-            for future in as_completed(future_to_log):
-                result = future.result()
+        session = aioboto3.Session()
+        async with session.client('s3', config=S3_CONFIG) as s3:
+            for future in asyncio.as_completed([download_worker(split, log_id) for split, log_id in all_downloads]):
+                result = await future
                 print(f"      {result}")
     
+    def download_all_detroit_data(self, max_workers=64):
+        """Download data for all found Detroit logs."""
+        
+        all_downloads = []
+        for split, log_ids in self.found_logs.items():
+            for log_id in log_ids:
+                all_downloads.append((split, log_id))
+        
+        if not all_downloads:
+            print("❌ No Detroit logs to download")
+            return
+        
+        print(f"\n📥 Downloading data for {len(all_downloads)} Detroit logs...")
+        print(f"Using up to {max_workers} concurrent S3 requests")
+        
+        asyncio.run(self._download_all_detroit_data(all_downloads, max_workers))
+    
     def create_download_manifest(self):
         """Create a manifest file with download information."""
         
@@ -215,19 +240,26 @@ class DetroitLogDownloader:
             if split_dir.exists():
                 manifest['directory_structure'][split] = {}
                 
-                for log_dir in split_dir.iterdir():
-                    if log_dir.is_dir():
-                        log_id = log_dir.name
-                        files = [f.name for f in log_dir.iterdir() if f.is_file()]
-                        manifest['directory_structure'][split][log_id] = {
-                            'files': files,
-                            'file_count': len(files),
-                            'total_size_bytes': sum(f.stat().st_size for f in log_dir.iterdir() if f.is_file())
-                        }
+                # os.scandir entries carry the file type from the directory read,
+                # so only the size lookup needs a stat() per file
+                with os.scandir(split_dir) as split_entries:
+                    log_dirs = [entry for entry in split_entries if entry.is_dir()]
+                
+                for log_dir in log_dirs:
+                    with os.scandir(log_dir.path) as log_entries:
+                        files = [entry for entry in log_entries if entry.is_file(follow_symlinks=False)]
+                    manifest['directory_structure'][split][log_dir.name] = {
+                        'files': [entry.name for entry in files],
+                        'file_count': len(files),
+                        'total_size_bytes': sum(entry.stat().st_size for entry in files)
+                    }
         
         manifest_file = self.base_dir / 'download_manifest.json'
-        with open(manifest_file, 'w') as f:
-            json.dump(manifest, f, indent=2)
+        if orjson:
+            manifest_file.write_bytes(orjson.dumps(manifest, option=orjson.OPT_INDENT_2))
+        else:
+            with open(manifest_file, 'w') as f:
+                json.dump(manifest, f, indent=2)
         
         print(f"📄 Manifest saved: {manifest_file}")
         return manifest_file
@@ -266,7 +298,7 @@ def main():
     
     # Download all data
     print(f"\n🚀 Starting download...")
-    downloader.download_all_detroit_data(max_workers=3)
+    downloader.download_all_detroit_data(max_workers=64)
     
     # Create manifest
     manifest_file = downloader.create_download_manifest()
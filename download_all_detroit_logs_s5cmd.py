@@ -11,9 +11,18 @@ import re
 import json
 import os
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor, as_completed
 import time
-from tqdm import tqdm
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Extracts the UUID from "DIR uuid/" lines of a split listing
+LOG_DIR_RE = re.compile(rb'DIR\s+([a-f0-9-]+)/')
+
+# Extracts "<log_id>/map/<filename>" from s5cmd wildcard listing lines
+MAP_ARCHIVE_RE = re.compile(rb'([a-f0-9-]+)/map/(\S+)')
 
 class DetroitLogDownloader:
     def __init__(self, base_dir="detroit_logs"):
@@ -25,6 +34,7 @@ class DetroitLogDownloader:
             (self.base_dir / split).mkdir(exist_ok=True)
         
         self.found_logs = {'train': [], 'val': [], 'test': []}
+        self.detroit_map_files = {'train': {}, 'val': {}, 'test': {}}  # log_id -> DTW map archive filename
         self.download_stats = {'downloaded': 0, 'failed': 0, 'skipped': 0}
     
     def find_detroit_logs_in_split(self, split):
@@ -35,37 +45,37 @@ class DetroitLogDownloader:
         try:
             # Get list of all logs using s5cmd
             print(f"   Getting log list for {split}...")
-            cmd = f"s5cmd ls s3://argoverse/datasets/av2/sensor/{split}/"
-            result = subprocess.run(cmd, shell=True, capture_output=True, text=True, timeout=120)
+            cmd = ['s5cmd', 'ls', f"s3://argoverse/datasets/av2/sensor/{split}/"]
+            result = subprocess.run(cmd, capture_output=True, timeout=120)
             
             if result.returncode != 0:
                 print(f"   Failed to list logs in {split}")
                 return []
             
-            # Extract log IDs from s5cmd output
-            log_ids = [] 
-            for line in result.stdout.strip().split('\n'):
-                if 'DIR' in line:
-                    # Extract UUID from "DIR uuid/"
-                    match = re.search(r'DIR\s+([a-f0-9-]+)/', line)
-                    if match:
-                        log_ids.append(match.group(1))
+            # Extract log IDs from the raw s5cmd output; only the short UUIDs are decoded
+            log_ids = [match.group(1).decode('ascii') for match in LOG_DIR_RE.finditer(result.stdout)]
             
             print(f"   Found {len(log_ids)} total logs in {split}")
             
-            # Process all logs to find Detroit data
-            detroit_logs = []
-            total_logs = len(log_ids)
+            # Find every Detroit map archive in the split with one wildcard listing
+            # instead of listing each log's map directory separately
+            print(f"   Listing Detroit map archives in {split}...")
+            map_cmd = ['s5cmd', 'ls', f"s3://argoverse/datasets/av2/sensor/{split}/*/map/*log_map_archive*DTW*"]
+            map_result = subprocess.run(map_cmd, capture_output=True, timeout=600)
             
-            # Use tqdm for progress bar
-            for i, log_id in enumerate(tqdm(log_ids, desc=f"Checking {split} logs")):
-                # Check if this log has Detroit map data
-                map_cmd = f"s5cmd ls s3://argoverse/datasets/av2/sensor/{split}/{log_id}/map/ | grep DTW"
-                map_result = subprocess.run(map_cmd, shell=True, capture_output=True, text=True, timeout=30)
-                
-                if map_result.returncode == 0 and map_result.stdout.strip():
-                    detroit_logs.append(log_id)
-                    print(f"\n   Found Detroit log: {log_id}")
+            detroit_logs = []
+            split_map_files = self.detroit_map_files[split]
+            if map_result.returncode == 0:
+                for line in map_result.stdout.splitlines():
+                    match = MAP_ARCHIVE_RE.search(line)
+                    if not match:
+                        continue
+                    log_id = match.group(1).decode('ascii')
+                    if log_id not in split_map_files:
+                        filename = match.group(2).decode()
+                        detroit_logs.append(log_id)
+                        split_map_files[log_id] = filename
+                        print(f"   Found Detroit log: {log_id}")
             
             print(f"   Found {len(detroit_logs)} Detroit logs in {split}")
             return detroit_logs
@@ -94,8 +104,24 @@ class DetroitLogDownloader:
         
         return total_found > 0
     
-    def download_log_data(self, split, log_id):
-        """Download essential data for a single Detroit log using s5cmd."""
+    def find_map_file(self, split, log_id):
+        """List a single log's map directory to find its DTW map archive filename."""
+        
+        try:
+            map_cmd = ['s5cmd', 'ls', f"s3://argoverse/datasets/av2/sensor/{split}/{log_id}/map/"]
+            map_result = subprocess.run(map_cmd, capture_output=True, timeout=30)
+            
+            if map_result.returncode == 0:
+                for line in map_result.stdout.splitlines():
+                    if b'log_map_archive' in line and b'DTW' in line:
+                        return line.split()[-1].decode()
+        except:
+            pass
+        
+        return None
+    
+    def get_log_files(self, split, log_id):
+        """List the essential files to download for a single Detroit log."""
         
         log_dir = self.base_dir / split / log_id
         log_dir.mkdir(exist_ok=True)
@@ -108,55 +134,59 @@ class DetroitLogDownloader:
             }
         ]
         
-        # Find and download the Detroit map file
+        # Find the Detroit map file
+        # (usually already located by the bulk listing during discovery)
+        filename = self.detroit_map_files[split].get(log_id) or self.find_map_file(split, log_id)
+        if filename:
+            files_to_download.append({
+                'name': 'map',
+                'path': f'{log_id}/map/{filename}',
+                'local': log_dir / f'map_{filename}'
+            })
+        
+        return files_to_download
+    
+    def run_batch_download(self, downloads, max_workers=32):
+        """
+        Download many files with a single `s5cmd run` invocation.
+        
+        `downloads` is a list of (split, file_info) pairs. Files that already
+        exist locally are left out of the command file. s5cmd schedules the
+        transfers itself over one connection pool.
+        """
+        
+        commands_file = self.base_dir / 's5cmd_download_commands.txt'
+        pending = 0
+        with open(commands_file, 'w') as f:
+            for split, file_info in downloads:
+                if file_info['local'].exists():
+                    continue
+                s3_path = f"s3://argoverse/datasets/av2/sensor/{split}/{file_info['path']}"
+                f.write(f"cp {s3_path} {file_info['local']}\n")
+                pending += 1
+        
+        if pending == 0:
+            print("   All files already exist, nothing to download")
+            return
+        
+        print(f"   Downloading {pending} files with s5cmd ({max_workers} workers)...")
         try:
-            # List map files to find the DTW one
-            map_cmd = f"s5cmd ls s3://argoverse/datasets/av2/sensor/{split}/{log_id}/map/"
-            map_result = subprocess.run(map_cmd, shell=True, capture_output=True, text=True, timeout=30)
-            
-            if map_result.returncode == 0:
-                for line in map_result.stdout.strip().split('\n'):
-                    if 'log_map_archive' in line and 'DTW' in line:
-                        filename = line.split()[-1]
-                        files_to_download.append({
-                            'name': 'map',
-                            'path': f'{log_id}/map/{filename}',
-                            'local': log_dir / f'map_{filename}'
-                        })
-                        break
-        except:
-            pass
+            result = subprocess.run(['s5cmd', '--numworkers', str(max_workers), 'run', str(commands_file)])
+            if result.returncode != 0:
+                print(f"   Some s5cmd transfers failed (exit code {result.returncode})")
+        except Exception as e:
+            print(f"   Error running s5cmd: {e}")
+    
+    def download_log_data(self, split, log_id):
+        """Download essential data for a single Detroit log using s5cmd."""
         
-        # Download each file using s5cmd
-        downloaded = 0
-        for file_info in files_to_download:
-            s3_path = f"s3://argoverse/datasets/av2/sensor/{split}/{file_info['path']}"
-            local_path = file_info['local']
-            
-            if local_path.exists():
-                print(f"      Skipping {file_info['name']} (already exists)")
-                downloaded += 1
-                continue
-            
-            try:
-                cmd = f"s5cmd cp {s3_path} {local_path}"
-                result = subprocess.run(cmd, shell=True, timeout=300)  # 5 min timeout
-                
-                if result.returncode == 0 and local_path.exists():
-                    print(f"      Downloaded {file_info['name']}")
-                    downloaded += 1
-                else:
-                    print(f"      Failed to download {file_info['name']}")
-                    
-            except subprocess.TimeoutExpired:
-                print(f"      Timeout downloading {file_info['name']}")
-            except Exception as e:
-                print(f"      Error downloading {file_info['name']}: {e}")
+        files_to_download = self.get_log_files(split, log_id)
+        self.run_batch_download([(split, file_info) for file_info in files_to_download])
         
-        return downloaded > 0
+        return any(file_info['local'].exists() for file_info in files_to_download)
     
-    def download_all_detroit_data(self, max_workers=5):
-        """Download data for all found Detroit logs using parallel s5cmd operations."""
+    def download_all_detroit_data(self, max_workers=32):
+        """Download data for all found Detroit logs with one batched s5cmd run."""
         
         all_downloads = []
         for split, log_ids in self.found_logs.items():
@@ -168,32 +198,26 @@ class DetroitLogDownloader:
             return
         
         print(f"\nDownloading data for {len(all_downloads)} Detroit logs...")
-        print(f"Using {max_workers} parallel downloads")
+        print(f"Using {max_workers} s5cmd workers")
         
-        def download_worker(split_log):
-            split, log_id = split_log
-            print(f"   Downloading {split}/{log_id[:8]}...")
-            
-            try:
-                success = self.download_log_data(split, log_id)
-                if success:
-                    self.download_stats['downloaded'] += 1
-                    return f"Success: {split}/{log_id[:8]}"
-                else:
-                    self.download_stats['failed'] += 1
-                    return f"Failed: {split}/{log_id[:8]}"
-            except Exception as e:
-                self.download_stats['failed'] += 1
-                return f"Error: {split}/{log_id[:8]}: {e}"
+        # Build one command file covering every log instead of one process per file
+        log_files = {}
+        for split, log_id in all_downloads:
+            log_files[(split, log_id)] = self.get_log_files(split, log_id)
         
-        # Download with thread pool
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            future_to_log = {executor.submit(download_worker, dl): dl for dl in all_downloads}
-            
-            # Use tqdm for progress bar
-            for future in tqdm(as_completed(future_to_log), total=len(all_downloads), desc="Downloading logs"):
-                result = future.result()
-                print(f"\n      {result}")
+        self.run_batch_download([
+            (split, file_info)
+            for (split, log_id), files in log_files.items()
+            for file_info in files
+        ], max_workers=max_workers)
+        
+        # A log counts as downloaded if any of its files made it to disk
+        for (split, log_id), files in log_files.items():
+            if any(file_info['local'].exists() for file_info in files):
+                self.download_stats['downloaded'] += 1
+            else:
+                self.download_stats['failed'] += 1
+                print(f"      Failed: {split}/{log_id[:8]}")
     
     def create_download_manifest(self):
         """Create a manifest file with download information."""
@@ -211,19 +235,26 @@ class DetroitLogDownloader:
             if split_dir.exists():
                 manifest['directory_structure'][split] = {}
                 
-                for log_dir in split_dir.iterdir():
-                    if log_dir.is_dir():
-                        log_id = log_dir.name
-                        files = [f.name for f in log_dir.iterdir() if f.is_file()]
-                        manifest['directory_structure'][split][log_id] = {
-                            'files': files,
-                            'file_count': len(files),
-                            'total_size_bytes': sum(f.stat().st_size for f in log_dir.iterdir() if f.is_file())
-                        }
+                # os.scandir entries carry the file type from the directory read,
+                # so only the size lookup needs a stat() per file
+                with os.scandir(split_dir) as split_entries:
+                    log_dirs = [entry for entry in split_entries if entry.is_dir()]
+                
+                for log_dir in log_dirs:
+                    with os.scandir(log_dir.path) as log_entries:
+                        files = [entry for entry in log_entries if entry.is_file(follow_symlinks=False)]
+                    manifest['directory_structure'][split][log_dir.name] = {
+                        'files': [entry.name for entry in files],
+                        'file_count': len(files),
+                        'total_size_bytes': sum(entry.stat().st_size for entry in files)
+                    }
         
         manifest_file = self.base_dir / 'download_manifest.json'
-        with open(manifest_file, 'w') as f:
-            json.dump(manifest, f, indent=2)
+        if orjson:
+            manifest_file.write_bytes(orjson.dumps(manifest, option=orjson.OPT_INDENT_2))
+        else:
+            with open(manifest_file, 'w') as f:
+                json.dump(manifest, f, indent=2)
         
         print(f"Manifest saved: {manifest_file}")
         return manifest_file
@@ -273,7 +304,7 @@ def main():
     
     # Download all data
     print(f"\nStarting download...")
-    downloader.download_all_detroit_data(max_workers=5)  # Increased workers for s5cmd
+    downloader.download_all_detroit_data(max_workers=32)
     
     # Create manifest
     manifest_file = downloader.create_download_manifest()
@@ -4,59 +4,130 @@ Download Motion Forecasting HD Maps
 
 Download HD map JSON files from Argoverse 2 Motion Forecasting dataset.
 Organize them in motion_forecasting/{split}/{log_id}/ structure.
+
+Scenario listing uses one shared boto3 client with anonymous (unsigned)
+requests. Downloads run on an asyncio event loop per shard process using
+aioboto3, with a semaphore bounding the requests in flight.
 """
 
-import subprocess
-import re
+import asyncio
 import json
 import os
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import multiprocessing as mp
+import queue
 import time
 from tqdm import tqdm
 
+import aioboto3
+import boto3
+from botocore import UNSIGNED
+from botocore.config import Config
+
+S3_BUCKET = 'argoverse'
+MOTION_FORECASTING_PREFIX = 'datasets/av2/motion-forecasting'
+
+# Scenario IDs rarely change, so a cached listing is reused for this long
+SCENARIO_LIST_CACHE_TTL_SECONDS = 24 * 60 * 60
+
+# Per-file cap for one map download (~50-200KB); botocore retries transient errors within it
+DOWNLOAD_TIMEOUT_SECONDS = 30
+
+# Shard workers report progress to the parent every this many finished files
+PROGRESS_REPORT_EVERY = 16
+
+# How often the parent drains worker progress while shards are running
+PROGRESS_POLL_SECONDS = 0.5
+
+def _s3_config(max_pool_connections):
+    """Unsigned client config for the public bucket; the pool must cover every concurrent request."""
+    return Config(
+        signature_version=UNSIGNED,
+        max_pool_connections=max_pool_connections,
+        retries={'max_attempts': 5, 'mode': 'adaptive'}
+    )
+
 class MotionForecastingDownloader:
     def __init__(self, base_dir="motion_forecasting"):
         self.base_dir = Path(base_dir)
         self.base_dir.mkdir(exist_ok=True)
         
+        # One session and client for scenario listing; downloads use aioboto3 per shard
+        self._session = boto3.session.Session()
+        self._s3 = self._session.client('s3', config=_s3_config(10))
+        
         # Create split directories
         for split in ['train', 'val', 'test']:
             (self.base_dir / split).mkdir(exist_ok=True)
         
         self.found_scenarios = {'train': [], 'val': [], 'test': []}
         self.download_stats = {'downloaded': 0, 'failed': 0, 'skipped': 0}
+        # (split, scenario_id, filename, size) for every map on disk, recorded as it is downloaded or skipped
+        self.downloaded_files = []
+        
+        # {(split, scenario_id): size} of maps already on disk, from one directory walk
+        self._existing_maps = self._scan_existing_maps()
+    
+    def _scan_existing_maps(self):
+        """Walk the download tree once with os.scandir and record every map file already present."""
+        
+        existing = {}
+        for split in ['train', 'val', 'test']:
+            with os.scandir(self.base_dir / split) as split_entries:
+                scenario_dirs = [entry for entry in split_entries if entry.is_dir()]
+            
+            for scenario_dir in scenario_dirs:
+                map_filename = f"log_map_archive_{scenario_dir.name}.json"
+                with os.scandir(scenario_dir.path) as scenario_entries:
+                    for entry in scenario_entries:
+                        if entry.name == map_filename and entry.is_file(follow_symlinks=False):
+                            existing[(split, scenario_dir.name)] = entry.stat().st_size
+        return existing
     
     def find_scenarios_in_split(self, split):
         """Find all scenarios in a specific split."""
         
         print(f"\nFinding scenarios in {split} split...")
         
+        # Reuse a recent listing instead of paging through the bucket again
+        cache_file = self.base_dir / f"scenarios_{split}.json"
+        if cache_file.exists() and time.time() - cache_file.stat().st_mtime < SCENARIO_LIST_CACHE_TTL_SECONDS:
+            with open(cache_file) as f:
+                scenario_ids = json.load(f)
+            print(f"   Loaded {len(scenario_ids)} cached scenarios for {split} from {cache_file}")
+            return scenario_ids
+        
         try:
             # Get list of all scenarios
             print(f"   Getting scenario list for {split}...")
-            cmd = f"aws s3 ls --no-sign-request s3://argoverse/datasets/av2/motion-forecasting/{split}/"
-            result = subprocess.run(cmd, shell=True, capture_output=True, text=True, timeout=120)
+            prefix = f"{MOTION_FORECASTING_PREFIX}/{split}/"
+            paginator = self._s3.get_paginator('list_objects_v2')
             
-            if result.returncode != 0:
-                print(f"   Failed to list scenarios in {split}")
-                return []
+            # List every key under the split once ("<prefix><uuid>/<file>") so scenarios and the
+            # presence of their map file come from the same pages; no per-object HEAD is ever needed
+            scenario_ids = []
+            all_scenarios = set()
+            for page in paginator.paginate(Bucket=S3_BUCKET, Prefix=prefix, PaginationConfig={'PageSize': 1000}):
+                for obj in page.get('Contents', []):
+                    scenario_id, _, filename = obj['Key'][len(prefix):].partition('/')
+                    all_scenarios.add(scenario_id)
+                    if filename == f"log_map_archive_{scenario_id}.json":
+                        scenario_ids.append(scenario_id)
             
-            # Extract scenario IDs
-            scenario_ids = [] 
-            for line in result.stdout.strip().split('\n'):
-                if 'PRE' in line:
-                    # Extract UUID from "PRE uuid/"
-                    match = re.search(r'PRE\s+([a-f0-9-]+)/', line)
-                    if match:
-                        scenario_ids.append(match.group(1))
+            # Never cache an empty listing, and write through a temporary file so an
+            # interrupted run cannot leave a truncated cache that later runs would trust
+            if scenario_ids:
+                tmp_file = cache_file.with_name(cache_file.name + '.tmp')
+                with open(tmp_file, 'w') as f:
+                    json.dump(scenario_ids, f)
+                tmp_file.replace(cache_file)
             
-            print(f"   Found {len(scenario_ids)} scenarios in {split}")
+            print(f"   Found {len(scenario_ids)} scenarios with HD maps in {split}")
+            if len(all_scenarios) > len(scenario_ids):
+                print(f"   Skipping {len(all_scenarios) - len(scenario_ids)} scenarios without a map file")
             return scenario_ids
             
-        except subprocess.TimeoutExpired:
-            print(f"   Timeout while searching {split}")
-            return []
         except Exception as e:
             print(f"   Error searching {split}: {e}")
             return []
@@ -79,82 +150,92 @@ class MotionForecastingDownloader:
         
         return total_found > 0
     
-    def download_scenario_map(self, split, scenario_id):
-        """Download HD map JSON file for a single scenario."""
+    def download_all_maps(self, max_concurrency=128):
+        """Download HD map files for all found scenarios.
         
-        scenario_dir = self.base_dir / split / scenario_id
-        scenario_dir.mkdir(exist_ok=True)
-        
-        # HD map file to download
-        map_filename = f"log_map_archive_{scenario_id}.json"
-        local_path = scenario_dir / map_filename
-        
-        # Skip if already exists
-        if local_path.exists():
-            self.download_stats['skipped'] += 1
-            return True
-        
-        # Download the JSON map file
-        s3_path = f"s3://argoverse/datasets/av2/motion-forecasting/{split}/{scenario_id}/{map_filename}"
-        
-        try:
-            cmd = f"aws s3 cp --no-sign-request {s3_path} {local_path}"
-            result = subprocess.run(cmd, shell=True, timeout=300)  # 5 min timeout
-            
-            if result.returncode == 0 and local_path.exists():
-                self.download_stats['downloaded'] += 1
-                return True
-            else:
-                self.download_stats['failed'] += 1
-                return False
-                
-        except subprocess.TimeoutExpired:
-            self.download_stats['failed'] += 1
-            return False
-        except Exception as e:
-            self.download_stats['failed'] += 1
-            return False
-    
-    def download_all_maps(self, max_workers=5):
-        """Download HD map files for all found scenarios."""
+        Scenarios are sharded by the first hex character of their UUID; each shard
+        runs in its own process with its own aioboto3 session and event loop, with
+        up to `max_concurrency` downloads in flight.
+        """
         
-        all_downloads = []
+        # Deduplicate scenario IDs and settle already-downloaded maps here, so workers only get missing ones;
+        # the rest is partitioned into (up to) 16 shards by first hex character of the UUID
+        seen = set()
+        shards = {}
         for split, scenario_ids in self.found_scenarios.items():
             for scenario_id in scenario_ids:
-                all_downloads.append((split, scenario_id))
+                if (split, scenario_id) in seen:
+                    continue
+                seen.add((split, scenario_id))
+                if (split, scenario_id) in self._existing_maps:
+                    self.downloaded_files.append((split, scenario_id, f"log_map_archive_{scenario_id}.json",
+                                                  self._existing_maps[(split, scenario_id)]))
+                    self.download_stats['skipped'] += 1
+                else:
+                    shards.setdefault(scenario_id[0], []).append((split, scenario_id))
         
-        if not all_downloads:
+        if not seen:
             print("No scenarios to download")
             return
         
-        print(f"\nDownloading HD maps for {len(all_downloads)} scenarios...")
-        print(f"Using {max_workers} parallel downloads")
-        print("=" * 60)
+        total_downloads = sum(len(shard) for shard in shards.values())
+        if not total_downloads:
+            print(f"\nAll {len(seen)} HD maps already downloaded")
+            return
         
-        def download_worker(split_scenario):
-            split, scenario_id = split_scenario
-            return self.download_scenario_map(split, scenario_id)
+        n_processes = min(len(shards), os.cpu_count() or 1)
+        print(f"\nDownloading HD maps for {total_downloads} scenarios...")
+        print(f"Using {n_processes} processes x {max_concurrency} concurrent downloads across {len(shards)} shards")
+        print("=" * 60)
         
-        # Download with thread pool and progress bar
+        # Download with process pool and progress bar; workers stream (finished, failed) counts
+        # over a queue while they run, and each shard reports its stats and files back when done
         start_time = time.time()
-        with tqdm(total=len(all_downloads), desc="Downloading HD maps", unit="files") as pbar:
-            with ThreadPoolExecutor(max_workers=max_workers) as executor:
-                future_to_scenario = {executor.submit(download_worker, dl): dl for dl in all_downloads}
+        progress_queue = mp.Queue()
+        live_failed = 0
+        with tqdm(total=total_downloads, desc="Downloading HD maps", unit="files") as pbar:
+            with ProcessPoolExecutor(max_workers=n_processes, initializer=init_download_worker,
+                                     initargs=(progress_queue,)) as executor:
+                shard_sizes = {
+                    executor.submit(download_shard_worker, str(self.base_dir), shard, max_concurrency): len(shard)
+                    for shard in shards.values()
+                }
+                pending = set(shard_sizes)
                 
-                for future in as_completed(future_to_scenario):
-                    split, scenario_id = future_to_scenario[future]
-                    success = future.result()
+                while pending:
+                    done, pending = wait(pending, timeout=PROGRESS_POLL_SECONDS, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        # A crashed shard loses its results; count all of its downloads as failed and keep the rest
+                        try:
+                            shard_stats, shard_files = future.result()
+                        except Exception as e:
+                            print(f"\nShard worker failed: {type(e).__name__}: {e} ({shard_sizes[future]} downloads counted as failed)")
+                            self.download_stats['failed'] += shard_sizes[future]
+                            continue
+                        for key, count in shard_stats.items():
+                            self.download_stats[key] += count
+                        self.downloaded_files.extend(shard_files)
+                    
+                    while True:
+                        try:
+                            finished, failed = progress_queue.get_nowait()
+                        except queue.Empty:
+                            break
+                        pbar.update(min(finished, total_downloads - pbar.n))
+                        live_failed += failed
+                    if not pending:
+                        pbar.update(total_downloads - pbar.n)  # Counts still in flight on the queue
                     
                     # Update progress bar with detailed info
                     elapsed = time.time() - start_time
                     rate = pbar.n / elapsed if elapsed > 0 else 0
+                    failed_so_far = max(live_failed, self.download_stats['failed'])
                     pbar.set_postfix({
-                        'Downloaded': self.download_stats['downloaded'],
+                        'Downloaded': pbar.n - failed_so_far,
                         'Skipped': self.download_stats['skipped'], 
-                        'Failed': self.download_stats['failed'],
+                        'Failed': failed_so_far,
                         'Rate': f"{rate:.1f}/s"
                     })
-                    pbar.update(1)
     
     def create_download_manifest(self):
         """Create a manifest file with download information."""
@@ -167,21 +248,16 @@ class MotionForecastingDownloader:
             'directory_structure': {}
         }
         
-        # Scan downloaded files
+        # Group the files recorded during download; no directory walk or stat() afterwards
         for split in ['train', 'val', 'test']:
-            split_dir = self.base_dir / split
-            if split_dir.exists():
-                manifest['directory_structure'][split] = {}
-                
-                for scenario_dir in split_dir.iterdir():
-                    if scenario_dir.is_dir():
-                        scenario_id = scenario_dir.name
-                        files = [f.name for f in scenario_dir.iterdir() if f.is_file()]
-                        manifest['directory_structure'][split][scenario_id] = {
-                            'files': files,
-                            'file_count': len(files),
-                            'total_size_bytes': sum(f.stat().st_size for f in scenario_dir.iterdir() if f.is_file())
-                        }
+            manifest['directory_structure'][split] = {}
+        for split, scenario_id, filename, size in self.downloaded_files:
+            entry = manifest['directory_structure'][split].setdefault(
+                scenario_id, {'files': [], 'file_count': 0, 'total_size_bytes': 0}
+            )
+            entry['files'].append(filename)
+            entry['file_count'] += 1
+            entry['total_size_bytes'] += size
         
         manifest_file = self.base_dir / 'download_manifest.json'
         with open(manifest_file, 'w') as f:
@@ -190,6 +266,97 @@ class MotionForecastingDownloader:
         print(f"\nManifest saved: {manifest_file}")
         return manifest_file
 
+class ShardDownload:
+    """Per-process state for downloading one shard: target directory, stats, files and progress.
+    
+    Unlike MotionForecastingDownloader it builds no boto3 session and makes no directories up
+    front; its only client is the aioboto3 one opened for the shard.
+    """
+    
+    def __init__(self, base_dir, progress_queue=None):
+        self.base_dir = Path(base_dir)
+        self.download_stats = {'downloaded': 0, 'failed': 0, 'skipped': 0}
+        self.downloaded_files = []
+        self._progress_queue = progress_queue
+        self._unreported = [0, 0]  # (finished, failed) not yet sent to the parent
+    
+    def _record(self, failed):
+        """Count one finished file and report to the parent every PROGRESS_REPORT_EVERY files."""
+        self._unreported[0] += 1
+        self._unreported[1] += failed
+        if self._unreported[0] >= PROGRESS_REPORT_EVERY:
+            self.flush_progress()
+    
+    def flush_progress(self):
+        """Send the counts accumulated since the last report to the parent."""
+        if self._progress_queue is not None and self._unreported[0]:
+            self._progress_queue.put(tuple(self._unreported))
+        self._unreported = [0, 0]
+    
+    async def download_scenario_map(self, s3, semaphore, split, scenario_id):
+        """Download HD map JSON file for a single scenario."""
+        
+        # HD map file to download (maps already on disk were settled by the parent)
+        map_filename = f"log_map_archive_{scenario_id}.json"
+        scenario_dir = self.base_dir / split / scenario_id
+        scenario_dir.mkdir(parents=True, exist_ok=True)
+        local_path = scenario_dir / map_filename
+        
+        # Download the JSON map file
+        key = f"{MOTION_FORECASTING_PREFIX}/{split}/{scenario_id}/{map_filename}"
+        
+        # Download to a temporary name so a failed or timed-out transfer never leaves a
+        # partial file that later runs would skip as "already exists"
+        part_path = local_path.with_name(local_path.name + '.part')
+        try:
+            async with semaphore:
+                await asyncio.wait_for(s3.download_file(S3_BUCKET, key, str(part_path)), timeout=DOWNLOAD_TIMEOUT_SECONDS)
+            part_path.replace(local_path)
+            self.downloaded_files.append((split, scenario_id, map_filename, local_path.stat().st_size))
+            self.download_stats['downloaded'] += 1
+            self._record(failed=0)
+            return True
+        except Exception as e:
+            part_path.unlink(missing_ok=True)
+            # Report the first failure of each shard; the rest are only counted
+            if not self.download_stats['failed']:
+                print(f"   Failed to download {key}: {type(e).__name__}: {e} (further failures in this shard are counted only)")
+            self.download_stats['failed'] += 1
+            self._record(failed=1)
+            return False
+    
+    async def download_all(self, downloads, max_concurrency):
+        """Download one shard concurrently, with at most max_concurrency S3 requests in flight."""
+        semaphore = asyncio.Semaphore(max_concurrency)
+        session = aioboto3.Session()
+        try:
+            async with session.client('s3', config=_s3_config(max_concurrency)) as s3:
+                await asyncio.gather(*[
+                    self.download_scenario_map(s3, semaphore, split, scenario_id) for split, scenario_id in downloads
+                ])
+        finally:
+            self.flush_progress()
+
+# Progress queue to the parent, set once per worker process by the pool initializer
+_progress_queue = None
+
+def init_download_worker(progress_queue):
+    """Executor initializer: keep the parent's progress queue for every shard this process runs."""
+    global _progress_queue
+    _progress_queue = progress_queue
+
+def download_shard_worker(base_dir, downloads, max_concurrency):
+    """Download one shard of (split, scenario_id) pairs in a worker process.
+    
+    Runs the shard on its own event loop (aioboto3 sessions are not fork-safe, so each
+    shard opens its own) and returns download_stats and downloaded_files to the parent.
+    """
+    
+    shard = ShardDownload(base_dir, _progress_queue)
+    asyncio.run(shard.download_all(downloads, max_concurrency))
+    
+    return shard.download_stats, shard.downloaded_files
+
 def main():
     """Main function."""
     
@@ -218,7 +385,7 @@ def main():
     print(f"   Estimated total size: ~{(total_scenarios * 100) / 1024:.1f}MB")
     
     # Download all maps
-    downloader.download_all_maps(max_workers=8)  # Increased workers for smaller files
+    downloader.download_all_maps(max_concurrency=128)  # Per shard process; small files are request-bound
     
     # Create manifest
     manifest_file = downloader.create_download_manifest()
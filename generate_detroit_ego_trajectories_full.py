@@ -1,4 +1,5 @@
 import os
+from concurrent.futures import ProcessPoolExecutor
 import pyarrow.feather as feather
 import simplekml
 from av2.geometry.utm import convert_city_coords_to_wgs84
@@ -7,12 +8,27 @@ import numpy as np
 DETROIT_CITY_NAME = "DTW"
 LOGS_BASE = "detroit_logs"
 OUTPUT_KML = "detroit_ego_trajectories"
+# Only the translation columns are needed; the quaternion and timestamp columns are never read
+POSE_COLUMNS = ['tx_m', 'ty_m', 'tz_m']
 
 
-def get_gps_from_city_coords(x, y, z):
-    point_2d = np.array([[x, y]])
-    lat_lon = convert_city_coords_to_wgs84(point_2d, DETROIT_CITY_NAME)[0]
-    return lat_lon[0], lat_lon[1], z
+def get_gps_from_city_coords(xyz):
+    """Convert an (N, 3) array of city coordinates to an (N, 3) array of KML (lon, lat, alt)."""
+    lat_lon = convert_city_coords_to_wgs84(xyz[:, :2], DETROIT_CITY_NAME)
+    return np.column_stack([lat_lon[:, 1], lat_lon[:, 0], xyz[:, 2]])
+
+
+def _process_log(log_dir):
+    """Read one log's poses and convert them to KML coords; returns None if the log has no poses."""
+    pose_path = os.path.join(log_dir, "city_SE3_egovehicle.feather")
+    if not os.path.exists(pose_path):
+        return None
+    table = feather.read_table(pose_path, columns=POSE_COLUMNS)
+    if table.num_rows == 0:
+        return None
+    # Convert the whole log in one call instead of once per pose row
+    xyz = np.stack([table.column(c).to_numpy() for c in POSE_COLUMNS], axis=1).astype(np.float64, copy=False)
+    return get_gps_from_city_coords(xyz).tolist()
 
 
 def main():
@@ -21,17 +37,12 @@ def main():
         split_dir = os.path.join(LOGS_BASE, split)
         if not os.path.exists(split_dir):
             continue
-        for log_id in os.listdir(split_dir):
-            log_dir = os.path.join(split_dir, log_id)
-            pose_path = os.path.join(log_dir, "city_SE3_egovehicle.feather")
-            if not os.path.exists(pose_path):
-                continue
-            poses = feather.read_feather(pose_path)
-            coords = []
-            for i, row in poses.iterrows():
-                x, y, z = row['tx_m'], row['ty_m'], row['tz_m']
-                lat, lon, alt = get_gps_from_city_coords(x, y, z)
-                coords.append((lon, lat, alt))
+        log_ids = os.listdir(split_dir)
+        log_dirs = [os.path.join(split_dir, log_id) for log_id in log_ids]
+        # Logs are independent: read + convert in worker processes, build the KML in the parent
+        with ProcessPoolExecutor() as ex:
+            results = list(ex.map(_process_log, log_dirs))
+        for log_id, coords in zip(log_ids, results):
             if coords:
                 ls = kml.newlinestring(name=f"{split}/{log_id}", coords=coords)
                 ls.style.linestyle.color = simplekml.Color.red if split == 'train' else simplekml.Color.green if split == 'val' else simplekml.Color.blue
@@ -4,19 +4,112 @@ Generate Detroit HD Maps KML
 
 Convert Detroit HD map data (lane segments, drivable areas, pedestrian crossings)
 into KML format for visualization in Google Earth or other mapping applications.
+
+Placemarks are streamed straight to disk as they are generated rather than
+being accumulated in a simplekml document.
 """
 
+import io
 import json
 import os
+import zipfile
 import simplekml
+from contextlib import ExitStack, contextmanager
+from functools import lru_cache
 from pathlib import Path
+from xml.sax.saxutils import escape
 from av2.geometry.utm import convert_city_coords_to_wgs84
 import numpy as np
-from typing import List, Dict, Any, Tuple
+from typing import List, Dict, Any, TextIO, Tuple
+
+try:
+    import orjson  # Much faster decode for map archive JSON
+except ImportError:
+    orjson = None
 
 DETROIT_CITY_NAME = "DTW"
 LOGS_BASE = "detroit_logs"  # Use existing detroit_logs directory
 
+# Polyline fields of each map element type; flattened to (N, 3) arrays right after parsing
+POLYLINE_FIELDS = {
+    'lane_segments': ('left_lane_boundary', 'right_lane_boundary'),
+    'pedestrian_crossings': ('edge1', 'edge2'),
+    'drivable_areas': ('area_boundary',),
+}
+EMPTY_POLYLINE = np.empty((0, 3))
+
+KML_HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n<kml xmlns="http://www.opengis.net/kml/2.2">\n<Document>\n'
+KML_FOOTER = '</Document>\n</kml>\n'
+
+def _poly_to_array(points: List[Dict[str, float]]) -> np.ndarray:
+    """Flatten a list of {x, y, z} point dicts into a contiguous (N, 3) float64 array."""
+    return np.fromiter(
+        (v for p in points for v in (p['x'], p['y'], p['z'])), dtype=np.float64, count=3 * len(points)
+    ).reshape(-1, 3)
+
+@contextmanager
+def _open_kml_output(output_file):
+    """Open a text stream for a .kml file, or for doc.kml inside a deflated .kmz archive."""
+    if str(output_file).endswith('.kmz'):
+        with zipfile.ZipFile(output_file, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=6) as zf:
+            with zf.open('doc.kml', 'w', force_zip64=True) as raw:  # A full split's doc.kml can exceed 2 GiB
+                with io.TextIOWrapper(io.BufferedWriter(raw, buffer_size=1 << 20), encoding='utf-8') as out:
+                    yield out
+    else:
+        with open(output_file, 'w', encoding='utf-8', buffering=1 << 20) as out:
+            yield out
+
+@contextmanager
+def _kml_stream(output_file, name, description=None):
+    """
+    Open a KML (or KMZ) document for streaming output.
+    
+    The header is written on entry and the closing tags on exit, so placemarks
+    go straight to disk instead of accumulating in a simplekml object graph.
+    """
+    with _open_kml_output(output_file) as out:
+        out.write(KML_HEADER)
+        out.write(f'<name>{escape(name)}</name>\n')
+        if description is not None:
+            out.write(f'<description>{escape(description)}</description>\n')
+        yield out
+        out.write(KML_FOOTER)
+
+@lru_cache(maxsize=4096)
+def _coords_template(n_points: int) -> str:
+    """Return the %-format template for a KML coordinates string of n_points vertices."""
+    return ' '.join(['%.7f,%.7f,%.3f'] * n_points)
+
+def _format_coords(coords: np.ndarray) -> str:
+    """Format an (N, 3) lon/lat/alt array as a KML coordinates string with one %-operation."""
+    return _coords_template(len(coords)) % tuple(coords.ravel().tolist())
+
+def _line_style(color: str, width: int) -> str:
+    """Return an inline <Style> fragment for a line placemark."""
+    return f'<Style><LineStyle><color>{color}</color><width>{width}</width></LineStyle></Style>'
+
+def _polygon_style(poly_color: str, line_color: str, line_width: int) -> str:
+    """Return an inline <Style> fragment for an outlined polygon placemark."""
+    return (
+        f'<Style><LineStyle><color>{line_color}</color><width>{line_width}</width></LineStyle>'
+        f'<PolyStyle><color>{poly_color}</color><outline>1</outline></PolyStyle></Style>'
+    )
+
+def _emit_linestring(out: TextIO, name: str, coords: np.ndarray, style: str, description: str):
+    """Write one LineString placemark with a prebuilt style fragment."""
+    out.write(
+        f'<Placemark><name>{escape(name)}</name><description>{escape(description)}</description>{style}'
+        f'<LineString><coordinates>{_format_coords(coords)}</coordinates></LineString></Placemark>\n'
+    )
+
+def _emit_polygon(out: TextIO, name: str, coords: np.ndarray, style: str, description: str):
+    """Write one Polygon placemark with a prebuilt style fragment."""
+    out.write(
+        f'<Placemark><name>{escape(name)}</name><description>{escape(description)}</description>{style}'
+        f'<Polygon><outerBoundaryIs><LinearRing><coordinates>{_format_coords(coords)}</coordinates>'
+        f'</LinearRing></outerBoundaryIs></Polygon></Placemark>\n'
+    )
+
 class DetroitHDMapKMLGenerator:
     def __init__(self, base_dir=LOGS_BASE):
         self.base_dir = Path(base_dir)
@@ -50,6 +143,14 @@ class DetroitHDMapKMLGenerator:
             'DASH_SOLID_YELLOW': {'color': simplekml.Color.yellow, 'width': 3},
             'NONE': {'color': simplekml.Color.gray, 'width': 1}
         }
+        
+        # Style fragments are built once here so the emission loop only does a string lookup
+        self._lane_style_frags = {
+            mark_type: _line_style(style['color'], style['width'])
+            for mark_type, style in self.lane_mark_styles.items()
+        }
+        self._crossing_style_frag = _line_style(self.colors['pedestrian_crossings'], 4)
+        self._area_style_frag = _polygon_style(self.colors['drivable_areas'], simplekml.Color.darkblue, 2)
     
     def get_gps_from_city_coords(self, x: float, y: float, z: float) -> Tuple[float, float, float]:
         """Convert city coordinates to GPS coordinates."""
@@ -57,53 +158,86 @@ class DetroitHDMapKMLGenerator:
         lat_lon = convert_city_coords_to_wgs84(point_2d, DETROIT_CITY_NAME)[0]
         return lat_lon[0], lat_lon[1], z
     
-    def convert_polyline_to_gps(self, polyline: List[Dict[str, float]]) -> List[Tuple[float, float, float]]:
+    def convert_polylines_to_gps(self, polylines: List[np.ndarray]) -> List[np.ndarray]:
+        """Convert several (N, 3) city-coordinate polylines to (N, 3) lon/lat/alt arrays with a single UTM transform."""
+        lengths = [len(polyline) for polyline in polylines]
+        if not sum(lengths):
+            return [EMPTY_POLYLINE for _ in polylines]
+        
+        # Concatenate every point, transform once, then split back per polyline
+        points = np.concatenate(polylines)
+        lat_lon = convert_city_coords_to_wgs84(points[:, :2], DETROIT_CITY_NAME)
+        gps_points = np.column_stack([lat_lon[:, 1], lat_lon[:, 0], points[:, 2]])  # KML expects (lon, lat, alt)
+        return np.split(gps_points, np.cumsum(lengths)[:-1])
+    
+    def convert_polyline_to_gps(self, polyline: np.ndarray) -> np.ndarray:
         """Convert a polyline from city coordinates to GPS coordinates."""
-        gps_coords = []
-        for point in polyline:
-            lat, lon, alt = self.get_gps_from_city_coords(point['x'], point['y'], point['z'])
-            gps_coords.append((lon, lat, alt))  # KML expects (lon, lat, alt)
-        return gps_coords
+        return self.convert_polylines_to_gps([polyline])[0]
     
-    def add_lane_segments(self, kml: simplekml.Kml, lane_segments: Dict[str, Any], split: str, log_id: str) -> int:
-        """Add lane segments to the KML. Returns number of features added."""
+    def _load_gps_cache(self, cache_file: Path, map_stat: os.stat_result, lengths: List[int]):
+        """Return cached GPS polylines if the cache matches the map file's mtime/size and polyline layout."""
+        if not cache_file.exists():
+            return None
+        try:
+            with np.load(cache_file) as cache:
+                if (int(cache['source_mtime_ns']) != map_stat.st_mtime_ns
+                        or int(cache['source_size']) != map_stat.st_size
+                        or not np.array_equal(cache['lengths'], lengths)):
+                    return None
+                gps_points = cache['gps_points']
+        except Exception:
+            return None
+        return np.split(gps_points, np.cumsum(lengths)[:-1])
+    
+    def _save_gps_cache(self, cache_file: Path, map_stat: os.stat_result, lengths: List[int], gps_polylines: List[np.ndarray]):
+        """Store converted polylines as one coordinate block plus per-polyline lengths."""
+        try:
+            np.savez(
+                cache_file,
+                gps_points=np.concatenate(gps_polylines) if gps_polylines else EMPTY_POLYLINE,
+                lengths=np.asarray(lengths, dtype=np.int64),
+                source_mtime_ns=map_stat.st_mtime_ns,
+                source_size=map_stat.st_size
+            )
+        except OSError as e:
+            print(f"      ⚠️  Could not write GPS cache {cache_file}: {e}")
+    
+    def add_lane_segments(self, out: TextIO, lane_segments: Dict[str, Any], split: str, log_id: str) -> int:
+        """
+        Add lane segments to the KML. Returns number of features added.
+        
+        Boundaries must already be (N, 3) lon/lat/alt arrays (see process_map_file).
+        """
         features_added = 0
         for lane_id, lane_data in lane_segments.items():
             try:
-                # Get lane type and color
+                # Get lane type
                 lane_type = lane_data.get('lane_type', 'VEHICLE')
-                color = self.colors['lane_segments'].get(lane_type, simplekml.Color.blue)
                 
                 # Add left lane boundary
                 if 'left_lane_boundary' in lane_data:
-                    left_coords = self.convert_polyline_to_gps(lane_data['left_lane_boundary'])
+                    left_coords = lane_data['left_lane_boundary']
                     if len(left_coords) >= 2:
                         left_mark_type = lane_data.get('left_lane_mark_type', 'NONE')
-                        style = self.lane_mark_styles.get(left_mark_type, self.lane_mark_styles['NONE'])
+                        style = self._lane_style_frags.get(left_mark_type, self._lane_style_frags['NONE'])
                         
-                        left_line = kml.newlinestring(
-                            name=f"{split}/{log_id[:8]}/L{lane_id}/left",
-                            coords=left_coords
+                        _emit_linestring(
+                            out, f"{split}/{log_id[:8]}/L{lane_id}/left", left_coords, style,
+                            f"Lane {lane_id} - {lane_type} - Left boundary ({left_mark_type})"
                         )
-                        left_line.style.linestyle.color = style['color']
-                        left_line.style.linestyle.width = style['width']
-                        left_line.description = f"Lane {lane_id} - {lane_type} - Left boundary ({left_mark_type})"
                         features_added += 1
                 
                 # Add right lane boundary
                 if 'right_lane_boundary' in lane_data:
-                    right_coords = self.convert_polyline_to_gps(lane_data['right_lane_boundary'])
+                    right_coords = lane_data['right_lane_boundary']
                     if len(right_coords) >= 2:
                         right_mark_type = lane_data.get('right_lane_mark_type', 'NONE')
-                        style = self.lane_mark_styles.get(right_mark_type, self.lane_mark_styles['NONE'])
+                        style = self._lane_style_frags.get(right_mark_type, self._lane_style_frags['NONE'])
                         
-                        right_line = kml.newlinestring(
-                            name=f"{split}/{log_id[:8]}/L{lane_id}/right",
-                            coords=right_coords
+                        _emit_linestring(
+                            out, f"{split}/{log_id[:8]}/L{lane_id}/right", right_coords, style,
+                            f"Lane {lane_id} - {lane_type} - Right boundary ({right_mark_type})"
                         )
-                        right_line.style.linestyle.color = style['color']
-                        right_line.style.linestyle.width = style['width']
-                        right_line.description = f"Lane {lane_id} - {lane_type} - Right boundary ({right_mark_type})"
                         features_added += 1
                 
                 self.stats['lane_segments'] += 1
@@ -113,35 +247,33 @@ class DetroitHDMapKMLGenerator:
         
         return features_added
     
-    def add_pedestrian_crossings(self, kml: simplekml.Kml, pedestrian_crossings: Dict[str, Any], split: str, log_id: str) -> int:
-        """Add pedestrian crossings to the KML. Returns number of features added."""
+    def add_pedestrian_crossings(self, out: TextIO, pedestrian_crossings: Dict[str, Any], split: str, log_id: str) -> int:
+        """
+        Add pedestrian crossings to the KML. Returns number of features added.
+        
+        Edges must already be (N, 3) lon/lat/alt arrays (see process_map_file).
+        """
         features_added = 0
         for crossing_id, crossing_data in pedestrian_crossings.items():
             try:
                 # Add edge1
                 if 'edge1' in crossing_data:
-                    edge1_coords = self.convert_polyline_to_gps(crossing_data['edge1'])
+                    edge1_coords = crossing_data['edge1']
                     if len(edge1_coords) >= 2:
-                        edge1_line = kml.newlinestring(
-                            name=f"{split}/{log_id[:8]}/C{crossing_id}/edge1",
-                            coords=edge1_coords
+                        _emit_linestring(
+                            out, f"{split}/{log_id[:8]}/C{crossing_id}/edge1", edge1_coords,
+                            self._crossing_style_frag, f"Pedestrian crossing {crossing_id} - Edge 1"
                         )
-                        edge1_line.style.linestyle.color = self.colors['pedestrian_crossings']
-                        edge1_line.style.linestyle.width = 4
-                        edge1_line.description = f"Pedestrian crossing {crossing_id} - Edge 1"
                         features_added += 1
                 
                 # Add edge2
                 if 'edge2' in crossing_data:
-                    edge2_coords = self.convert_polyline_to_gps(crossing_data['edge2'])
+                    edge2_coords = crossing_data['edge2']
                     if len(edge2_coords) >= 2:
-                        edge2_line = kml.newlinestring(
-                            name=f"{split}/{log_id[:8]}/C{crossing_id}/edge2",
-                            coords=edge2_coords
+                        _emit_linestring(
+                            out, f"{split}/{log_id[:8]}/C{crossing_id}/edge2", edge2_coords,
+                            self._crossing_style_frag, f"Pedestrian crossing {crossing_id} - Edge 2"
                         )
-                        edge2_line.style.linestyle.color = self.colors['pedestrian_crossings']
-                        edge2_line.style.linestyle.width = 4
-                        edge2_line.description = f"Pedestrian crossing {crossing_id} - Edge 2"
                         features_added += 1
                 
                 self.stats['pedestrian_crossings'] += 1
@@ -151,24 +283,23 @@ class DetroitHDMapKMLGenerator:
         
         return features_added
     
-    def add_drivable_areas(self, kml: simplekml.Kml, drivable_areas: Dict[str, Any], split: str, log_id: str) -> int:
-        """Add drivable areas to the KML. Returns number of features added."""
+    def add_drivable_areas(self, out: TextIO, drivable_areas: Dict[str, Any], split: str, log_id: str) -> int:
+        """
+        Add drivable areas to the KML. Returns number of features added.
+        
+        Boundaries must already be (N, 3) lon/lat/alt arrays (see process_map_file).
+        """
         features_added = 0
         for area_id, area_data in drivable_areas.items():
             try:
                 if 'area_boundary' in area_data:
-                    boundary_coords = self.convert_polyline_to_gps(area_data['area_boundary'])
+                    boundary_coords = area_data['area_boundary']
                     if len(boundary_coords) >= 3:  # Need at least 3 points for a polygon
                         # Create polygon
-                        polygon = kml.newpolygon(
-                            name=f"{split}/{log_id[:8]}/A{area_id}",
-                            outerboundaryis=boundary_coords
+                        _emit_polygon(
+                            out, f"{split}/{log_id[:8]}/A{area_id}", boundary_coords,
+                            self._area_style_frag, f"Drivable area {area_id}"
                         )
-                        polygon.style.polystyle.color = self.colors['drivable_areas']
-                        polygon.style.polystyle.outline = 1
-                        polygon.style.linestyle.color = simplekml.Color.darkblue
-                        polygon.style.linestyle.width = 2
-                        polygon.description = f"Drivable area {area_id}"
                         features_added += 1
                         
                         self.stats['drivable_areas'] += 1
@@ -178,27 +309,56 @@ class DetroitHDMapKMLGenerator:
         
         return features_added
     
-    def process_map_file(self, kml: simplekml.Kml, map_file_path: Path, split: str, log_id: str) -> int:
+    def process_map_file(self, out: TextIO, map_file_path: Path, split: str, log_id: str) -> int:
         """Process a single map file and add its elements to the KML. Returns number of features added."""
         features_added = 0
         try:
-            with open(map_file_path, 'r') as f:
-                map_data = json.load(f)
+            map_bytes = map_file_path.read_bytes()
+            map_data = orjson.loads(map_bytes) if orjson else json.loads(map_bytes)
+            
+            # Flatten every polyline to an (N, 3) array once, so conversion never touches point dicts;
+            # a malformed polyline is dropped on its own instead of failing the whole map file
+            polyline_slots = []
+            for element_type, fields in POLYLINE_FIELDS.items():
+                for element_id, element in map_data.get(element_type, {}).items():
+                    for field in fields:
+                        if field in element:
+                            try:
+                                element[field] = _poly_to_array(element[field])
+                            except (KeyError, TypeError, ValueError) as e:
+                                print(f"      ⚠️  Skipping malformed {field} of {element_type} {element_id}: {e!r}")
+                                del element[field]
+                                continue
+                            polyline_slots.append((element, field))
+            
+            # Map archives never change, so reuse the converted coordinates cached next to the file
+            # (keyed on its mtime + size); otherwise convert every polyline with one UTM transform
+            lengths = [len(element[field]) for element, field in polyline_slots]
+            cache_file = map_file_path.with_name(f"{map_file_path.stem}.latlon.npz")
+            map_stat = map_file_path.stat()
+            gps_polylines = self._load_gps_cache(cache_file, map_stat, lengths)
+            if gps_polylines is None:
+                gps_polylines = self.convert_polylines_to_gps([element[field] for element, field in polyline_slots])
+                self._save_gps_cache(cache_file, map_stat, lengths, gps_polylines)
+            
+            # Store the GPS arrays in place of the city-coordinate polylines
+            for (element, field), gps_coords in zip(polyline_slots, gps_polylines):
+                element[field] = gps_coords
             
             # Process lane segments
             if 'lane_segments' in map_data:
                 print(f"      🛣️  Processing {len(map_data['lane_segments'])} lane segments...")
-                features_added += self.add_lane_segments(kml, map_data['lane_segments'], split, log_id)
+                features_added += self.add_lane_segments(out, map_data['lane_segments'], split, log_id)
             
             # Process pedestrian crossings
             if 'pedestrian_crossings' in map_data:
                 print(f"      🚶 Processing {len(map_data['pedestrian_crossings'])} pedestrian crossings...")
-                features_added += self.add_pedestrian_crossings(kml, map_data['pedestrian_crossings'], split, log_id)
+                features_added += self.add_pedestrian_crossings(out, map_data['pedestrian_crossings'], split, log_id)
             
             # Process drivable areas
             if 'drivable_areas' in map_data:
                 print(f"      🚗 Processing {len(map_data['drivable_areas'])} drivable areas...")
-                features_added += self.add_drivable_areas(kml, map_data['drivable_areas'], split, log_id)
+                features_added += self.add_drivable_areas(out, map_data['drivable_areas'], split, log_id)
             
             self.stats['logs_processed'] += 1
             
@@ -207,51 +367,69 @@ class DetroitHDMapKMLGenerator:
         
         return features_added
     
-    def create_split_kml(self, split: str) -> List[simplekml.Kml]:
-        """Create KML files for a specific split, splitting into chunks if needed."""
+    def create_split_kml(self, split: str) -> List[Tuple[str, int]]:
+        """
+        Stream KML files for a specific split, splitting into chunks if needed.
+        
+        Returns (filename, feature_count) for every chunk written.
+        """
         split_dir = self.base_dir / split
         if not split_dir.exists():
             return []
         
         print(f"\n📁 Processing {split} split...")
         
-        # Create first KML chunk
-        kml_chunks = [simplekml.Kml()]
-        kml_chunks[0].name = f"Detroit HD Maps - {split.capitalize()} - Part 1"
-        kml_chunks[0].description = f"Detroit HD Maps for {split} split (Part 1)"
-        
-        current_chunk = 0
-        feature_count = 0
         max_features_per_chunk = 9500  # Leave some buffer below 10,000
         
-        for log_dir in split_dir.iterdir():
-            if not log_dir.is_dir():
-                continue
+        with ExitStack() as stack:
+            chunks = []
+            feature_count = 0
             
-            log_id = log_dir.name
-            map_dir = log_dir / 'map'
+            def open_chunk():
+                part = len(chunks) + 1
+                # Split chunks are large and highly repetitive XML, so they are written deflated as KMZ
+                filename = f"detroit_hd_maps_{split}_part_{part}.kmz"
+                chunks.append([filename, 0])
+                return stack.enter_context(_kml_stream(
+                    filename,
+                    f"Detroit HD Maps - {split.capitalize()} - Part {part}",
+                    f"Detroit HD Maps for {split} split (Part {part})"
+                ))
             
-            if not map_dir.exists():
-                continue
+            out = open_chunk()
             
-            # Find vector map files (JSON files with DTW in name)
-            for map_file in map_dir.glob("log_map_archive_*____DTW_city_*.json"):
-                print(f"   📄 Processing {split}/{log_id[:8]} - {map_file.name}")
+            for log_dir in split_dir.iterdir():
+                if not log_dir.is_dir():
+                    continue
                 
-                # Check if we need a new chunk
-                if feature_count >= max_features_per_chunk:
-                    current_chunk += 1
-                    kml_chunks.append(simplekml.Kml())
-                    kml_chunks[current_chunk].name = f"Detroit HD Maps - {split.capitalize()} - Part {current_chunk + 1}"
-                    kml_chunks[current_chunk].description = f"Detroit HD Maps for {split} split (Part {current_chunk + 1})"
-                    feature_count = 0
-                    print(f"      📦 Starting new chunk {current_chunk + 1}...")
+                log_id = log_dir.name
+                map_dir = log_dir / 'map'
                 
-                # Process the file and count features added
-                features_added = self.process_map_file(kml_chunks[current_chunk], map_file, split, log_id)
-                feature_count += features_added
+                if not map_dir.exists():
+                    continue
+                
+                # Find vector map files (JSON files with DTW in name)
+                for map_file in map_dir.glob("log_map_archive_*____DTW_city_*.json"):
+                    print(f"   📄 Processing {split}/{log_id[:8]} - {map_file.name}")
+                    
+                    # Check if we need a new chunk; the finished one is closed before the next opens
+                    if feature_count >= max_features_per_chunk:
+                        stack.close()
+                        out = open_chunk()
+                        feature_count = 0
+                        print(f"      📦 Starting new chunk {len(chunks)}...")
+                    
+                    # Process the file and count features added
+                    features_added = self.process_map_file(out, map_file, split, log_id)
+                    feature_count += features_added
+                    chunks[-1][1] += features_added
         
-        return kml_chunks
+        # Drop chunks that ended up without any features
+        for filename, count in chunks:
+            if not count:
+                Path(filename).unlink(missing_ok=True)
+        
+        return [(filename, count) for filename, count in chunks]
     
     def generate_all_kml_files(self):
         """Generate KML files for all splits."""
@@ -268,13 +446,9 @@ class DetroitHDMapKMLGenerator:
         
         # Create KML for each split
         for split in ['train', 'val', 'test']:
-            split_kml_chunks = self.create_split_kml(split)
-            
-            for kml_chunk in split_kml_chunks:
-                if kml_chunk.features:
-                    split_filename = f"detroit_hd_maps_{split}_part_{split_kml_chunks.index(kml_chunk) + 1}.kml"
-                    kml_chunk.save(split_filename)
-                    print(f"🗺️  {split.capitalize()} KML saved: {split_filename} ({len(kml_chunk.features)} features)")
+            for split_filename, feature_count in self.create_split_kml(split):
+                if feature_count:
+                    print(f"🗺️  {split.capitalize()} KML saved: {split_filename} ({feature_count} features)")
                 else:
                     print(f"⚠️  No data found for {split} split")
         
@@ -289,9 +463,8 @@ class DetroitHDMapKMLGenerator:
     
     def create_summary_kml(self):
         """Create a summary KML with representative samples."""
-        summary_kml = simplekml.Kml()
-        summary_kml.name = "Detroit HD Maps - Summary"
-        summary_kml.description = f"""
+        summary_filename = "detroit_hd_maps_summary.kml"
+        summary_description = f"""
         Detroit HD Maps Summary
         Generated from {self.stats['logs_processed']} logs
         
@@ -308,37 +481,36 @@ class DetroitHDMapKMLGenerator:
         - Light blue polygons: Drivable areas
         """
         
-        # Process a few sample files from each split
-        sample_count = 0
-        for split in ['train', 'val', 'test']:
-            split_dir = self.base_dir / split
-            if not split_dir.exists():
-                continue
-            
-            # Take first 2 logs from each split
-            for log_dir in list(split_dir.iterdir())[:2]:
-                if not log_dir.is_dir():
+        with _kml_stream(summary_filename, "Detroit HD Maps - Summary", summary_description) as out:
+            # Process a few sample files from each split
+            sample_count = 0
+            for split in ['train', 'val', 'test']:
+                split_dir = self.base_dir / split
+                if not split_dir.exists():
                     continue
                 
-                log_id = log_dir.name
-                map_dir = log_dir / 'map'
-                
-                if not map_dir.exists():
-                    continue
-                
-                for map_file in map_dir.glob("log_map_archive_*____DTW_city_*.json"):
-                    if sample_count >= 5:  # Limit to 5 sample files
-                        break
+                # Take first 2 logs from each split
+                for log_dir in list(split_dir.iterdir())[:2]:
+                    if not log_dir.is_dir():
+                        continue
                     
-                    print(f"   📄 Adding sample: {split}/{log_id[:8]} - {map_file.name}")
-                    self.process_map_file(summary_kml, map_file, split, log_id)
-                    sample_count += 1
-                
-                if sample_count >= 5:
-                    break
+                    log_id = log_dir.name
+                    map_dir = log_dir / 'map'
+                    
+                    if not map_dir.exists():
+                        continue
+                    
+                    for map_file in map_dir.glob("log_map_archive_*____DTW_city_*.json"):
+                        if sample_count >= 5:  # Limit to 5 sample files
+                            break
+                        
+                        print(f"   📄 Adding sample: {split}/{log_id[:8]} - {map_file.name}")
+                        self.process_map_file(out, map_file, split, log_id)
+                        sample_count += 1
+                    
+                    if sample_count >= 5:
+                        break
         
-        summary_filename = "detroit_hd_maps_summary.kml"
-        summary_kml.save(summary_filename)
         print(f"🗺️  Summary KML saved: {summary_filename}")
 
 def main():
@@ -376,9 +548,9 @@ def main():
     print(f"🚗 Generated {generator.stats['drivable_areas']} drivable areas")
     
     print(f"\n📁 Generated KML files:")
-    print(f"   - detroit_hd_maps_train_part_1.kml (training data)")
-    print(f"   - detroit_hd_maps_val_part_1.kml (validation data)")
-    print(f"   - detroit_hd_maps_test_part_1.kml (test data)")
+    print(f"   - detroit_hd_maps_train_part_1.kmz (training data)")
+    print(f"   - detroit_hd_maps_val_part_1.kmz (validation data)")
+    print(f"   - detroit_hd_maps_test_part_1.kmz (test data)")
     print(f"   - detroit_hd_maps_summary.kml (representative sample)")
     
     print(f"\n🗺️  Open these files in Google Earth or other KML viewers to visualize the HD maps!")
@@ -9,48 +9,280 @@ Updated with robust Detroit geo-fencing using official AV2 coordinate system.
 Optimized for processing 250k+ map files with parallel processing.
 """
 
+import hashlib
+import io
 import json
 import os
+import shelve
+import zipfile
 import simplekml
 import argparse
+from contextlib import contextmanager
+from functools import lru_cache
+from itertools import chain
+from operator import itemgetter
 from pathlib import Path
+from xml.sax.saxutils import escape
 from av2.geometry.utm import convert_city_coords_to_wgs84, CityName
 import numpy as np
-from typing import List, Dict, Any, Tuple, Optional
-from shapely.geometry import Point, Polygon
+from typing import List, Dict, Any, Tuple, Optional, TextIO
 import multiprocessing as mp
-from concurrent.futures import ProcessPoolExecutor, as_completed
-import gc
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from tqdm import tqdm
 import time
 
+try:
+    import orjson  # Much faster decode for map archive JSON
+except ImportError:
+    orjson = None
+
+try:
+    from pyproj import Proj  # Cached per-city projection; av2 rebuilds it on every conversion
+    from av2.geometry.utm import CITY_ORIGIN_LATLONG_DICT, UTM_ZONE_MAP
+except ImportError:
+    Proj = None
+
 MOTION_FORECASTING_BASE = "motion_forecasting"
 
+# Cities tried, in order, when converting city coordinates to GPS
+CITY_PROBE_ORDER = [CityName.DTW, CityName.ATX, CityName.MIA, CityName.PAO, CityName.PIT, CityName.WDC]
+
+# Initial rows of the per-worker coordinate buffer (grown by doubling when a scenario needs more)
+COORD_BUFFER_ROWS = 65536
+
+# Detroit GPS rectangle (lon/lat) used by the geofence, and the coarser Michigan bounds
+DETROIT_LON_RANGE = (-83.287, -82.910)
+DETROIT_LAT_RANGE = (42.255, 42.450)
+MICHIGAN_LON_RANGE = (-84.5, -82.0)
+MICHIGAN_LAT_RANGE = (41.5, 43.0)
+
+# Padding (m) around the estimated DTW city-frame footprint of the Detroit polygon (covers UTM curvature)
+DETROIT_CITY_BBOX_MARGIN_M = 1000.0
+
+# Lanes sampled per scenario, and the fraction of samples that must fall inside Detroit
+DETROIT_SAMPLE_LANES = 10
+DETROIT_MAJORITY = 0.5
+
+# Bump whenever the scenario-level Detroit decision logic changes in a way the parameters below do not capture
+DETROIT_LOGIC_VERSION = 2
+
+# Persistent per-scenario Detroit decisions, stored under the dataset directory; keys embed GEOFENCE_KEY,
+# so changing the fence, its prefilter margins, the sampling rule or the logic version invalidates them
+DETROIT_CACHE_FILE = ".detroit_cache.db"
+GEOFENCE_KEY = hashlib.sha1(repr((
+    DETROIT_LOGIC_VERSION, DETROIT_LON_RANGE, DETROIT_LAT_RANGE, MICHIGAN_LON_RANGE, MICHIGAN_LAT_RANGE,
+    DETROIT_CITY_BBOX_MARGIN_M, DETROIT_SAMPLE_LANES, DETROIT_MAJORITY
+)).encode()).hexdigest()[:12]
+
+# Extracts the (x, y, z) values of one raw map point
+_POINT_XYZ = itemgetter('x', 'y', 'z')
+
+# Polyline fields of each map element type
+POLYLINE_FIELDS = {
+    'lane_segments': ('left_lane_boundary', 'right_lane_boundary'),
+    'pedestrian_crossings': ('edge1', 'edge2'),
+    'drivable_areas': ('area_boundary',),
+}
+
+# Lane colors and marking widths, looked up through small integer indices
+LANE_TYPE_INDEX = {'VEHICLE': 0, 'BIKE': 1, 'BUS': 2, 'PEDESTRIAN': 3}
+LANE_TYPE_COLORS = [simplekml.Color.blue, simplekml.Color.green, simplekml.Color.orange, simplekml.Color.red]
+MARK_TYPE_INDEX = {
+    'SOLID_WHITE': 0, 'DASHED_WHITE': 1, 'SOLID_YELLOW': 2, 'DASHED_YELLOW': 3,
+    'DOUBLE_SOLID_YELLOW': 4, 'SOLID_DASH_YELLOW': 5, 'DASH_SOLID_YELLOW': 6, 'NONE': 7
+}
+MARK_TYPE_WIDTHS = [3, 2, 3, 2, 4, 3, 3, 1]
+NONE_MARK_INDEX = MARK_TYPE_INDEX['NONE']
+
+# Flat (kind, color, width) style table that features index into: one lane style per
+# (lane type, mark type) pair, then pedestrian crossings, then drivable areas
+STYLE_TABLE = [('line', color, width) for color in LANE_TYPE_COLORS for width in MARK_TYPE_WIDTHS] + [
+    ('line', simplekml.Color.yellow, 4),
+    ('polygon', simplekml.Color.lightblue, None),
+]
+CROSSING_STYLE_INDEX = len(STYLE_TABLE) - 2
+AREA_STYLE_INDEX = len(STYLE_TABLE) - 1
+
+def _lane_style_index(lane_type: str, mark_type: str) -> int:
+    """Return the STYLE_TABLE index for a lane boundary (unknown types fall back to VEHICLE / NONE)."""
+    return LANE_TYPE_INDEX.get(lane_type, 0) * len(MARK_TYPE_WIDTHS) + MARK_TYPE_INDEX.get(mark_type, NONE_MARK_INDEX)
+
+KML_HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n<kml xmlns="http://www.opengis.net/kml/2.2">\n<Document>\n'
+KML_FOOTER = '</Document>\n</kml>\n'
+
+@lru_cache(maxsize=8)
+def _city_projection(city_name) -> Tuple[Any, np.ndarray]:
+    """Return (UTM projector, city origin easting/northing) for a city, built once per process."""
+    city_name = CityName(city_name)
+    projector = Proj(proj="utm", zone=UTM_ZONE_MAP[city_name], ellps="WGS84", datum="WGS84", units="m")
+    latitude, longitude = CITY_ORIGIN_LATLONG_DICT[city_name]
+    return projector, np.array(projector(longitude, latitude), dtype=float)
+
+def city_coords_to_wgs84(points_city: np.ndarray, city_name) -> np.ndarray:
+    """
+    Convert (N, 2) city coordinates to (N, 2) lat/lon, like av2's convert_city_coords_to_wgs84.
+    
+    av2 constructs two Proj objects and inverse-projects point by point on every call; here the
+    projector and city origin are cached and the whole array is inverse-projected in one call.
+    """
+    if Proj is None:
+        return np.asarray(convert_city_coords_to_wgs84(points_city, city_name))
+    projector, origin_utm = _city_projection(city_name)
+    points_utm = np.asarray(points_city, dtype=float) + origin_utm
+    longitude, latitude = projector(points_utm[:, 0], points_utm[:, 1], inverse=True)
+    return np.column_stack((latitude, longitude))
+
+def batch_convert(xy: np.ndarray, city_name) -> np.ndarray:
+    """
+    Convert (N, 2) city coordinates to (N, 2) lat/lon, transforming each distinct point once.
+    
+    Neighbouring lanes share boundary vertices, so np.unique collapses the duplicates before
+    the UTM transform and the inverse index scatters the results back to every input row.
+    Each (x, y) row is viewed as one complex128 so the dedup is a plain 1-D sort.
+    """
+    keys = np.ascontiguousarray(xy, dtype=np.float64).view(np.complex128).reshape(-1)
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+    unique_xy = np.column_stack((unique_keys.real, unique_keys.imag))
+    return city_coords_to_wgs84(unique_xy, city_name)[inverse]
+
+def _first_map_point(map_data: Dict[str, Any]) -> Optional[Dict[str, float]]:
+    """Return the first point of the first non-empty polyline in a map, or None."""
+    for element_type, fields in POLYLINE_FIELDS.items():
+        for element in map_data.get(element_type, {}).values():
+            for field in fields:
+                if element.get(field):
+                    return element[field][0]
+    return None
+
+@contextmanager
+def _open_kml_output(output_file):
+    """Open a text stream for a .kml file, or for doc.kml inside a deflated .kmz archive."""
+    if str(output_file).endswith('.kmz'):
+        with zipfile.ZipFile(output_file, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=6) as zf:
+            with zf.open('doc.kml', 'w', force_zip64=True) as raw:  # A full split's doc.kml can exceed 2 GiB
+                with io.TextIOWrapper(io.BufferedWriter(raw, buffer_size=1 << 20), encoding='utf-8') as out:
+                    yield out
+    else:
+        with open(output_file, 'w', encoding='utf-8', buffering=1 << 20) as out:
+            yield out
+
+@contextmanager
+def _kml_stream(output_file, name, description=None):
+    """
+    Open a KML (or KMZ) document for streaming output.
+    
+    The header is written on entry and the closing tags on exit, so placemarks
+    go straight to disk instead of accumulating in a simplekml object graph.
+    """
+    with _open_kml_output(output_file) as out:
+        out.write(KML_HEADER)
+        out.write(f'<name>{escape(name)}</name>\n')
+        if description is not None:
+            out.write(f'<description>{escape(description)}</description>\n')
+        yield out
+        out.write(KML_FOOTER)
+
+@lru_cache(maxsize=4096)
+def _coords_template(n_points: int) -> str:
+    """Return the %-format template for a KML coordinates string of n_points vertices."""
+    return ' '.join(['%.7f,%.7f,%.3f'] * n_points)
+
+def _format_coords(coords: np.ndarray) -> str:
+    """Format an (N, 3) lon/lat/alt array as a KML coordinates string with one %-operation."""
+    return _coords_template(len(coords)) % tuple(coords.ravel().tolist())
+
+def _line_style(style_id: str, color: str, width: int) -> str:
+    """Return a shared <Style> block for line placemarks."""
+    return f'<Style id="{style_id}"><LineStyle><color>{color}</color><width>{width}</width></LineStyle></Style>\n'
+
+def _polygon_style(style_id: str, poly_color: str, line_color: str, line_width: int) -> str:
+    """Return a shared <Style> block for outlined polygon placemarks."""
+    return (
+        f'<Style id="{style_id}"><LineStyle><color>{line_color}</color><width>{line_width}</width></LineStyle>'
+        f'<PolyStyle><color>{poly_color}</color><outline>1</outline></PolyStyle></Style>\n'
+    )
+
+def _emit_linestring(out: TextIO, name: str, coords: np.ndarray, style_id: str, description: str):
+    """Write one LineString placemark referencing a shared style."""
+    out.write(
+        f'<Placemark><name>{escape(name)}</name><description>{escape(description)}</description>'
+        f'<styleUrl>#{style_id}</styleUrl>'
+        f'<LineString><coordinates>{_format_coords(coords)}</coordinates></LineString></Placemark>\n'
+    )
+
+def _emit_multilinestring(out: TextIO, name: str, coords_list: List[np.ndarray], style_id: str, description: str):
+    """Write one MultiGeometry placemark holding several LineStrings that share a style."""
+    lines = ''.join(f'<LineString><coordinates>{_format_coords(coords)}</coordinates></LineString>' for coords in coords_list)
+    out.write(
+        f'<Placemark><name>{escape(name)}</name><description>{escape(description)}</description>'
+        f'<styleUrl>#{style_id}</styleUrl><MultiGeometry>{lines}</MultiGeometry></Placemark>\n'
+    )
+
+def _emit_polygon(out: TextIO, name: str, coords: np.ndarray, style_id: str, description: str):
+    """Write one Polygon placemark referencing a shared style."""
+    out.write(
+        f'<Placemark><name>{escape(name)}</name><description>{escape(description)}</description>'
+        f'<styleUrl>#{style_id}</styleUrl>'
+        f'<Polygon><outerBoundaryIs><LinearRing><coordinates>{_format_coords(coords)}</coordinates>'
+        f'</LinearRing></outerBoundaryIs></Polygon></Placemark>\n'
+    )
+
 class RobustDetroitGeofence:
     """
     Robust geo-fencing for Detroit region using official city boundaries and AV2 coordinate system.
     """
     def __init__(self):
+        (min_lon, max_lon), (min_lat, max_lat) = DETROIT_LON_RANGE, DETROIT_LAT_RANGE
         self.detroit_polygon_gps = [
-            (-83.287, 42.255),
-            (-83.287, 42.450),
-            (-82.910, 42.450),
-            (-82.910, 42.255),
-            (-83.287, 42.255)
+            (min_lon, min_lat),
+            (min_lon, max_lat),
+            (max_lon, max_lat),
+            (max_lon, min_lat),
+            (min_lon, min_lat)
         ]
-        self.detroit_polygon = Polygon(self.detroit_polygon_gps)
         self.detroit_city_code = CityName.DTW
-        self.coordinate_cache = {}
+        self.detroit_city_bbox = self._estimate_detroit_city_bbox()
+        self._scratch = np.empty((1 << 15, 2), dtype=np.float64)  # Reused input for convert_batch
+    def convert_batch(self, xs, ys, city_name=None) -> np.ndarray:
+        """Convert city coordinates (scalars or arrays) to (N, 2) lat/lon via the reused scratch buffer."""
+        n = np.size(xs)
+        if n > len(self._scratch):
+            self._scratch = np.empty((max(n, 2 * len(self._scratch)), 2), dtype=np.float64)
+        xy = self._scratch[:n]
+        xy[:, 0] = xs
+        xy[:, 1] = ys
+        return city_coords_to_wgs84(xy, city_name or self.detroit_city_code.value)
+    def _estimate_detroit_city_bbox(self) -> Optional[Tuple[float, float, float, float]]:
+        """
+        Return a padded DTW city-frame (xmin, xmax, ymin, ymax) box around every point of the Detroit polygon.
+        
+        The local city->GPS Jacobian is measured with one conversion and inverted for the polygon
+        corners; the margin absorbs the projection's curvature, so anything outside the box is
+        guaranteed to fail the GPS polygon test.
+        """
+        try:
+            basis = city_coords_to_wgs84(
+                np.array([[0.0, 0.0], [1000.0, 0.0], [0.0, 1000.0]]), self.detroit_city_code.value)
+        except Exception:
+            return None
+        jacobian = np.column_stack((basis[1] - basis[0], basis[2] - basis[0])) / 1000.0  # d(lat, lon) / d(x, y)
+        corners = np.array([(lat, lon) for lon, lat in self.detroit_polygon_gps])
+        corners_xy = np.linalg.solve(jacobian, (corners - basis[0]).T).T
+        (xmin, ymin), (xmax, ymax) = corners_xy.min(axis=0), corners_xy.max(axis=0)
+        m = DETROIT_CITY_BBOX_MARGIN_M
+        return xmin - m, xmax + m, ymin - m, ymax + m
+    def in_detroit_city_bbox(self, xs, ys):
+        """Cheap city-frame prefilter (scalar or array): False means the point cannot be in Detroit."""
+        if self.detroit_city_bbox is None:
+            return np.ones(np.shape(xs), dtype=bool) if np.ndim(xs) else True
+        xmin, xmax, ymin, ymax = self.detroit_city_bbox
+        return (xmin <= xs) & (xs <= xmax) & (ymin <= ys) & (ys <= ymax)
     def coordinates_to_gps(self, x: float, y: float, z: float = 0.0) -> Optional[Tuple[float, float, float]]:
-        cache_key = (x, y)
-        if cache_key in self.coordinate_cache:
-            lat, lon = self.coordinate_cache[cache_key]
-            return lat, lon, z
         try:
-            point_2d = np.array([[x, y]])
-            lat_lon = convert_city_coords_to_wgs84(point_2d, self.detroit_city_code.value)[0]
+            lat_lon = self.convert_batch(x, y)[0]
             lat, lon = lat_lon[0], lat_lon[1]
-            self.coordinate_cache[cache_key] = (lat, lon)
             if abs(lat) > 0.1 and abs(lon) > 0.1:
                 return lat, lon, z
             else:
@@ -63,18 +295,33 @@ class RobustDetroitGeofence:
         if gps_coords is None:
             return False
         lat, lon, _ = gps_coords
-        point = Point(lon, lat)
-        return self.detroit_polygon.contains(point)
+        # The polygon is an axis-aligned rectangle, so containment (interior only) is four comparisons
+        return bool(DETROIT_LON_RANGE[0] < lon < DETROIT_LON_RANGE[1] and DETROIT_LAT_RANGE[0] < lat < DETROIT_LAT_RANGE[1])
+    def is_detroit_by_gps_polygon_batch(self, lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+        """Vectorized is_detroit_by_gps_polygon for GPS lat/lon arrays."""
+        return ((DETROIT_LON_RANGE[0] < lons) & (lons < DETROIT_LON_RANGE[1])
+                & (DETROIT_LAT_RANGE[0] < lats) & (lats < DETROIT_LAT_RANGE[1]))
+    def is_detroit_comprehensive_batch(self, lat_lon: np.ndarray) -> np.ndarray:
+        """
+        Vectorized form of is_detroit_comprehensive for an (N, 2) lat/lon array of DTW conversions.
+        
+        A point must be a plausible conversion, fall inside the Michigan bounds (inclusive),
+        and lie inside the Detroit polygon.
+        """
+        lat, lon = lat_lon[:, 0], lat_lon[:, 1]
+        plausible = (np.abs(lat) > 0.1) & (np.abs(lon) > 0.1)
+        in_michigan = ((MICHIGAN_LAT_RANGE[0] <= lat) & (lat <= MICHIGAN_LAT_RANGE[1])
+                       & (MICHIGAN_LON_RANGE[0] <= lon) & (lon <= MICHIGAN_LON_RANGE[1]))
+        return plausible & in_michigan & self.is_detroit_by_gps_polygon_batch(lat, lon)
     def is_detroit_by_coordinate_ranges(self, x: float, y: float) -> bool:
         detroit_bounds = {'min_x': 3000, 'max_x': 13000, 'min_y': 2000, 'max_y': 7000}
         return (detroit_bounds['min_x'] <= x <= detroit_bounds['max_x'] and detroit_bounds['min_y'] <= y <= detroit_bounds['max_y'])
     def is_detroit_by_city_detection(self, x: float, y: float, z: float = 0.0) -> bool:
         try:
-            point_2d = np.array([[x, y]])
-            lat_lon = convert_city_coords_to_wgs84(point_2d, self.detroit_city_code.value)[0]
+            lat_lon = self.convert_batch(x, y)[0]
             if abs(lat_lon[0]) > 0.1 and abs(lat_lon[1]) > 0.1:
                 lat, lon = lat_lon[0], lat_lon[1]
-                michigan_bounds = {'min_lat': 41.5, 'max_lat': 43.0, 'min_lon': -84.5, 'max_lon': -82.0}
+                michigan_bounds = {'min_lat': MICHIGAN_LAT_RANGE[0], 'max_lat': MICHIGAN_LAT_RANGE[1], 'min_lon': MICHIGAN_LON_RANGE[0], 'max_lon': MICHIGAN_LON_RANGE[1]}
                 return (michigan_bounds['min_lat'] <= lat <= michigan_bounds['max_lat'] and michigan_bounds['min_lon'] <= lon <= michigan_bounds['max_lon'])
             return False
         except Exception:
@@ -87,10 +334,14 @@ class RobustDetroitGeofence:
         elif method == "city_detection":
             return self.is_detroit_by_city_detection(x, y, z)
         else:
-            city_detection = self.is_detroit_by_city_detection(x, y, z)
-            if city_detection:
-                return self.is_detroit_by_gps_polygon(x, y, z)
-            return False
+            if not self.in_detroit_city_bbox(x, y):
+                return False
+            # One conversion feeds both the Michigan (city detection) and Detroit polygon tests
+            try:
+                lat_lon = self.convert_batch(x, y)
+            except Exception:
+                return False
+            return bool(self.is_detroit_comprehensive_batch(lat_lon)[0])
     def get_detection_info(self, x: float, y: float, z: float = 0.0) -> Dict[str, Any]:
         gps_coords = self.coordinates_to_gps(x, y, z)
         info = {
@@ -105,21 +356,44 @@ class RobustDetroitGeofence:
             info['gps_polygon'] = self.is_detroit_by_gps_polygon(x, y, z)
         info['comprehensive_result'] = self.is_detroit_comprehensive(x, y, z)
         return info
-    def analyze_scenario_location(self, map_data: Dict[str, Any]) -> Dict[str, Any]:
+    def _sample_lane_points(self, map_data: Dict[str, Any]) -> List[Tuple[float, float, float]]:
+        """First left-boundary point of each of the first DETROIT_SAMPLE_LANES lanes."""
         sample_coords = []
+        for i, lane_data in enumerate(map_data.get('lane_segments', {}).values()):
+            if i >= DETROIT_SAMPLE_LANES:
+                break
+            if lane_data.get('left_lane_boundary'):
+                first_point = lane_data['left_lane_boundary'][0]
+                sample_coords.append((first_point['x'], first_point['y'], first_point['z']))
+        return sample_coords
+    def fast_reject_non_detroit(self, map_data: Dict[str, Any]) -> bool:
+        """
+        True if a scenario can be rejected without any coordinate conversion.
+        
+        Every point analyze_scenario_location would sample must lie outside the Detroit city-frame
+        box; otherwise the scenario is left to the full analysis.
+        """
+        if self.detroit_city_bbox is None:
+            return False
+        return not any(self.in_detroit_city_bbox(x, y) for x, y, _ in self._sample_lane_points(map_data))
+    def analyze_scenario_location(self, map_data: Dict[str, Any]) -> Dict[str, Any]:
         detroit_detections = []
-        if 'lane_segments' in map_data:
-            for i, (lane_id, lane_data) in enumerate(map_data['lane_segments'].items()):
-                if i >= 10:
-                    break
-                if 'left_lane_boundary' in lane_data and lane_data['left_lane_boundary']:
-                    first_point = lane_data['left_lane_boundary'][0]
-                    x, y, z = first_point['x'], first_point['y'], first_point['z']
-                    sample_coords.append((x, y, z))
-                    detroit_detections.append(self.is_detroit_comprehensive(x, y, z))
+        sample_coords = self._sample_lane_points(map_data)
+        if sample_coords:
+            # Reject by the city-frame box first, then one DTW conversion and one
+            # vectorized rectangle test for the surviving samples
+            points_2d = np.array(sample_coords)[:, :2]
+            try:
+                detections = self.in_detroit_city_bbox(points_2d[:, 0], points_2d[:, 1])
+                if detections.any():
+                    lat_lon = batch_convert(points_2d[detections], self.detroit_city_code.value)
+                    detections[detections] = self.is_detroit_comprehensive_batch(lat_lon)
+                detroit_detections = detections.tolist()
+            except Exception:
+                detroit_detections = [self.is_detroit_comprehensive(x, y, z) for x, y, z in sample_coords]
         detroit_count = sum(detroit_detections)
         total_samples = len(detroit_detections)
-        is_detroit_scenario = (detroit_count / total_samples) > 0.5 if total_samples > 0 else False
+        is_detroit_scenario = (detroit_count / total_samples) > DETROIT_MAJORITY if total_samples > 0 else False
         return {
             'is_detroit': is_detroit_scenario,
             'detroit_confidence': detroit_count / total_samples if total_samples > 0 else 0.0,
@@ -132,18 +406,38 @@ class RobustDetroitGeofence:
 class OptimizedKMLProcessor:
     """Optimized processor for handling large numbers of map files."""
     
-    def __init__(self, detroit_only=False, include_lanes=True, include_drivable=False):
+    def __init__(self, detroit_only=False, include_lanes=True, include_drivable=False, group_by_style=False):
         self.detroit_only = detroit_only
         self.include_lanes = include_lanes
         self.include_drivable = include_drivable
+        self.group_by_style = group_by_style
         self.detroit_geofence = RobustDetroitGeofence() if detroit_only else None
         
-        # Global coordinate cache for all workers
-        self.global_coordinate_cache = {}
+        # Raw JSON keys of the map elements this run emits; scenarios containing none of them are never parsed
+        self._feature_keys = []
+        if include_lanes:
+            self._feature_keys += [b'"lane_segments"', b'"pedestrian_crossings"']
+        if include_drivable:
+            self._feature_keys.append(b'"drivable_areas"')
         
-    def process_scenario_batch(self, scenario_batch: List[Tuple[str, str, Path]]) -> Dict[str, Any]:
-        """Process a batch of scenarios and return KML features."""
+        # Reused 1x2 input for the single-point city probe
+        self._point_xy = np.empty((1, 2), dtype=np.float64)
+        
+        # Reused (N, 3) city-coordinate buffer; each scenario's points are written into it in place
+        self._coord_buf = np.empty((COORD_BUFFER_ROWS, 3), dtype=np.float64)
+        
+        # Malformed map archives are skipped; only the first one per worker is reported
+        self._reported_bad_map = False
+        
+    def process_scenario_batch(self, scenario_batch: List[Tuple[str, str, str, bool]]) -> Dict[str, Any]:
+        """
+        Process a batch of (split, scenario_id, map_file, known_detroit) entries and return KML features.
+        
+        In Detroit mode every geofence decision reached is returned under 'detroit_decisions' so the
+        parent can persist it; entries flagged known_detroit skip the geofence entirely.
+        """
         batch_features = []
+        detroit_decisions = {}
         batch_stats = {
             'lane_segments': 0,
             'pedestrian_crossings': 0,
@@ -151,188 +445,301 @@ class OptimizedKMLProcessor:
             'scenarios_processed': 0
         }
         
-        for split, scenario_id, map_file_path in scenario_batch:
-            try:
-                with open(map_file_path, 'r') as f:
-                    map_data = json.load(f)
-                
-                # Detroit filtering
-                if self.detroit_only and self.detroit_geofence:
-                    analysis = self.detroit_geofence.analyze_scenario_location(map_data)
-                    if not analysis['is_detroit']:
-                        continue
-                
-                # Process features
-                scenario_features = self.extract_scenario_features(map_data, split, scenario_id)
-                batch_features.extend(scenario_features)
-                
-                # Update stats
-                for feature in scenario_features:
-                    if 'lane_segment' in feature['name']:
-                        batch_stats['lane_segments'] += 1
-                    elif 'crossing' in feature['name']:
-                        batch_stats['pedestrian_crossings'] += 1
-                    elif 'drivable' in feature['name']:
-                        batch_stats['drivable_areas'] += 1
-                
-                batch_stats['scenarios_processed'] += 1
-                
-            except Exception as e:
-                continue
+        # A single reader thread loads archives ahead of the parse/convert loop below,
+        # so disk reads overlap with CPU work (file reads release the GIL)
+        with ThreadPoolExecutor(max_workers=1) as reader:
+            loaded = reader.map(self._read_scenario_map, scenario_batch)
+            for (split, scenario_id, map_file_path, known_detroit), map_bytes in zip(scenario_batch, loaded):
+                check_detroit = self.detroit_only and not known_detroit
+                if map_bytes is None:
+                    continue  # Scenario directory without a readable map archive
+                self._process_scenario_map(split, scenario_id, map_bytes, check_detroit, batch_features, batch_stats, detroit_decisions)
         
         return {
             'features': batch_features,
-            'stats': batch_stats
+            'stats': batch_stats,
+            'detroit_decisions': detroit_decisions
         }
     
-    def extract_scenario_features(self, map_data: Dict[str, Any], split: str, scenario_id: str) -> List[Dict[str, Any]]:
-        """Extract KML features from a single scenario."""
-        features = []
+    def _read_scenario_map(self, scenario: Tuple[str, str, str, bool]) -> Optional[bytes]:
+        """Read one scenario's map archive on the prefetch thread; None if it is missing or unreadable."""
+        map_file_path = scenario[2]
+        try:
+            with open(map_file_path, 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+    
+    def _process_scenario_map(self, split: str, scenario_id: str, map_bytes: bytes, check_detroit: bool,
+                              batch_features: List[Tuple], batch_stats: Dict[str, int],
+                              detroit_decisions: Dict[str, bool]):
+        """Parse one map archive and append its features, stats and Detroit decision to the batch."""
+        try:
+            # Fast path (Detroit mode): nothing to emit and no lanes for the geofence to sample. All-regions
+            # mode always parses, so a corrupt archive fails below instead of being counted as processed
+            if (self.detroit_only and b'"lane_segments"' not in map_bytes
+                    and not any(key in map_bytes for key in self._feature_keys)):
+                if check_detroit:
+                    detroit_decisions[scenario_id] = False
+                return
+            
+            map_data = orjson.loads(map_bytes) if orjson else json.loads(map_bytes)
+            
+            # Detroit filtering
+            if check_detroit and self.detroit_geofence:
+                is_detroit = (not self.detroit_geofence.fast_reject_non_detroit(map_data)
+                              and self.detroit_geofence.analyze_scenario_location(map_data)['is_detroit'])
+                detroit_decisions[scenario_id] = is_detroit
+                if not is_detroit:
+                    return
+            
+            # Process features
+            scenario_features = self.extract_scenario_features(map_data, split, scenario_id)
+            batch_features.extend(scenario_features)
+            
+            # Update stats
+            for _, name, _, _, _ in scenario_features:
+                if 'lane_segment' in name:
+                    batch_stats['lane_segments'] += 1
+                elif 'crossing' in name:
+                    batch_stats['pedestrian_crossings'] += 1
+                elif 'drivable' in name:
+                    batch_stats['drivable_areas'] += 1
+            
+            batch_stats['scenarios_processed'] += 1
+            
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            # Decode errors (orjson/json raise ValueError subclasses) or an archive missing expected fields
+            if not self._reported_bad_map:
+                self._reported_bad_map = True
+                print(f"Warning: Skipping malformed map archive for scenario {scenario_id}: {e!r} (further failures in this worker are not reported)")
+        except Exception as e:
+            # Anything else is a genuine failure rather than bad data: report every one, skip only this scenario
+            print(f"Error processing scenario {scenario_id}: {type(e).__name__}: {e}")
+    
+    def extract_scenario_features(self, map_data: Dict[str, Any], split: str, scenario_id: str) -> List[Tuple]:
+        """
+        Extract KML features from a single scenario.
+        
+        Each feature is a plain (kind, name, coords, style_index, description) tuple,
+        which pickles much faster than a dict when shipped back from a pool worker.
+        """
+        # Walk the map once, queueing every raw polyline with the feature it will become.
+        # Conversion can only drop points, so polylines already below a feature's minimum
+        # point count are skipped here instead of being converted and discarded.
+        polylines = []
+        pending_features = []  # (kind, name, style_index, description, min_points)
         
-        # Process lane segments
         if self.include_lanes and 'lane_segments' in map_data:
             for lane_id, lane_data in map_data['lane_segments'].items():
                 lane_type = lane_data.get('lane_type', 'VEHICLE')
-                
-                # Left boundary
-                if 'left_lane_boundary' in lane_data:
-                    left_coords = self.convert_polyline_to_gps(lane_data['left_lane_boundary'])
-                    if len(left_coords) >= 2:
-                        left_mark_type = lane_data.get('left_lane_mark_type', 'NONE')
-                        features.append({
-                            'type': 'linestring',
-                            'name': f"{split}/{scenario_id[:8]}/L{lane_id}/left",
-                            'coords': left_coords,
-                            'color': self.get_lane_color(lane_type),
-                            'width': self.get_lane_width(left_mark_type),
-                            'description': f"Lane {lane_id} - {lane_type} - Left boundary ({left_mark_type})"
-                        })
-                
-                # Right boundary
-                if 'right_lane_boundary' in lane_data:
-                    right_coords = self.convert_polyline_to_gps(lane_data['right_lane_boundary'])
-                    if len(right_coords) >= 2:
-                        right_mark_type = lane_data.get('right_lane_mark_type', 'NONE')
-                        features.append({
-                            'type': 'linestring',
-                            'name': f"{split}/{scenario_id[:8]}/L{lane_id}/right",
-                            'coords': right_coords,
-                            'color': self.get_lane_color(lane_type),
-                            'width': self.get_lane_width(right_mark_type),
-                            'description': f"Lane {lane_id} - {lane_type} - Right boundary ({right_mark_type})"
-                        })
-        
-        # Process pedestrian crossings
+                for side, side_name in (('left', 'Left'), ('right', 'Right')):
+                    boundary_field = f'{side}_lane_boundary'
+                    if len(lane_data.get(boundary_field, ())) >= 2:
+                        mark_type = lane_data.get(f'{side}_lane_mark_type', 'NONE')
+                        polylines.append(lane_data[boundary_field])
+                        pending_features.append((
+                            'linestring',
+                            f"{split}/{scenario_id[:8]}/L{lane_id}/{side}",
+                            _lane_style_index(lane_type, mark_type),
+                            f"Lane {lane_id} - {lane_type} - {side_name} boundary ({mark_type})",
+                            2
+                        ))
+        
         if self.include_lanes and 'pedestrian_crossings' in map_data:
             for crossing_id, crossing_data in map_data['pedestrian_crossings'].items():
                 for edge_name in ['edge1', 'edge2']:
-                    if edge_name in crossing_data:
-                        edge_coords = self.convert_polyline_to_gps(crossing_data[edge_name])
-                        if len(edge_coords) >= 2:
-                            features.append({
-                                'type': 'linestring',
-                                'name': f"{split}/{scenario_id[:8]}/C{crossing_id}/{edge_name}",
-                                'coords': edge_coords,
-                                'color': simplekml.Color.yellow,
-                                'width': 4,
-                                'description': f"Pedestrian crossing {crossing_id} - {edge_name}"
-                            })
-        
-        # Process drivable areas
+                    if len(crossing_data.get(edge_name, ())) >= 2:
+                        polylines.append(crossing_data[edge_name])
+                        pending_features.append((
+                            'linestring',
+                            f"{split}/{scenario_id[:8]}/C{crossing_id}/{edge_name}",
+                            CROSSING_STYLE_INDEX,
+                            f"Pedestrian crossing {crossing_id} - {edge_name}",
+                            2
+                        ))
+        
         if self.include_drivable and 'drivable_areas' in map_data:
             for area_id, area_data in map_data['drivable_areas'].items():
-                if 'area_boundary' in area_data:
-                    boundary_coords = self.convert_polyline_to_gps(area_data['area_boundary'])
-                    if len(boundary_coords) >= 3:
-                        features.append({
-                            'type': 'polygon',
-                            'name': f"{split}/{scenario_id[:8]}/A{area_id}",
-                            'coords': boundary_coords,
-                            'color': simplekml.Color.lightblue,
-                            'description': f"Drivable area {area_id}"
-                        })
+                if len(area_data.get('area_boundary', ())) >= 3:
+                    polylines.append(area_data['area_boundary'])
+                    pending_features.append((
+                        'polygon',
+                        f"{split}/{scenario_id[:8]}/A{area_id}",
+                        AREA_STYLE_INDEX,
+                        f"Drivable area {area_id}",
+                        3
+                    ))
+        
+        if not polylines:
+            return []
+        
+        # Resolve the city once, then convert every polyline of the scenario in one batch
+        city_name = self.resolve_scenario_city(map_data)
+        lengths = [len(polyline) for polyline in polylines]
+        points = self._fill_coord_buffer(polylines, sum(lengths))
+        gps_polylines = self._convert_points_to_gps(points, lengths, city_name)
         
+        features = []
+        for (kind, name, style_index, description, min_points), coords in zip(pending_features, gps_polylines):
+            if len(coords) >= min_points:
+                features.append((kind, name, coords, style_index, description))
+        if self.group_by_style:
+            features = self.group_lane_boundaries(features, split, scenario_id)
         return features
     
-    def convert_polyline_to_gps(self, polyline: List[Dict[str, float]]) -> List[Tuple[float, float, float]]:
-        """Convert polyline coordinates to GPS with caching."""
-        gps_coords = []
-        for point in polyline:
-            lat, lon, alt = self.get_gps_from_coords(point['x'], point['y'], point['z'])
-            if lat != 0.0 or lon != 0.0:
-                gps_coords.append((lon, lat, alt))
-        return gps_coords
+    def group_lane_boundaries(self, features: List[Tuple], split: str, scenario_id: str) -> List[Tuple]:
+        """Merge a scenario's lane boundaries into one 'multilinestring' feature per style."""
+        groups = {}
+        merged = []
+        for feature in features:
+            kind, _, coords, style_index, _ = feature
+            if kind == 'linestring' and style_index < CROSSING_STYLE_INDEX:
+                groups.setdefault(style_index, []).append(coords)
+            else:
+                merged.append(feature)
+        
+        lane_types = list(LANE_TYPE_INDEX)
+        mark_types = list(MARK_TYPE_INDEX)
+        grouped = []
+        for style_index, coords_list in groups.items():
+            lane_type_index, mark_type_index = divmod(style_index, len(MARK_TYPE_WIDTHS))
+            lane_type, mark_type = lane_types[lane_type_index], mark_types[mark_type_index]
+            grouped.append((
+                'multilinestring',
+                f"{split}/{scenario_id[:8]}/lanes/{lane_type}/{mark_type}",
+                coords_list,
+                style_index,
+                f"{len(coords_list)} lane boundaries - {lane_type} - {mark_type}"
+            ))
+        return grouped + merged
     
-    def get_gps_from_coords(self, x: float, y: float, z: float) -> Tuple[float, float, float]:
-        """Get GPS coordinates with global caching."""
-        cache_key = (x, y)
-        if cache_key in self.global_coordinate_cache:
-            lat, lon = self.global_coordinate_cache[cache_key]
-            return lat, lon, z
-        
-        if self.detroit_geofence:
-            result = self.detroit_geofence.coordinates_to_gps(x, y, z)
-            if result:
-                lat, lon, _ = result
-                self.global_coordinate_cache[cache_key] = (lat, lon)
-                return lat, lon, z
+    def resolve_scenario_city(self, map_data: Dict[str, Any]) -> Optional[CityName]:
+        """Return the first city giving a plausible GPS result for the scenario's first map point."""
+        first_point = _first_map_point(map_data)
+        if first_point is None:
+            return None
         
-        # Standard multi-city conversion
-        try:
-            city_names = [CityName.DTW, CityName.ATX, CityName.MIA, CityName.PAO, CityName.PIT, CityName.WDC]
-            for city_name in city_names:
-                try:
-                    point_2d = np.array([[x, y]])
-                    lat_lon = convert_city_coords_to_wgs84(point_2d, city_name)[0]
-                    if abs(lat_lon[0]) > 0.1 and abs(lat_lon[1]) > 0.1:
-                        lat, lon = lat_lon[0], lat_lon[1]
-                        self.global_coordinate_cache[cache_key] = (lat, lon)
-                        return lat, lon, z
-                except:
-                    continue
-        except:
-            pass
+        point_2d = self._point_xy
+        point_2d[0] = (first_point['x'], first_point['y'])
+        for city_name in CITY_PROBE_ORDER:
+            lat_lon = city_coords_to_wgs84(point_2d, city_name)[0]
+            if abs(lat_lon[0]) > 0.1 and abs(lat_lon[1]) > 0.1:
+                return city_name
+        return None
+    
+    def _fill_coord_buffer(self, polylines: List[List[Dict[str, float]]], n_points: int) -> np.ndarray:
+        """Write the points of raw {x, y, z} polylines into the reused buffer and return an (n_points, 3) view."""
+        if n_points > len(self._coord_buf):
+            rows = len(self._coord_buf)
+            while rows < n_points:
+                rows *= 2
+            self._coord_buf = np.empty((rows, 3), dtype=np.float64)
         
-        return 0.0, 0.0, z
+        points = self._coord_buf[:n_points]
+        # Stream x, y, z straight into a flat float array rather than materializing 3N Python floats
+        xyz = chain.from_iterable(map(_POINT_XYZ, chain.from_iterable(polylines)))
+        points.reshape(-1)[:] = np.fromiter(xyz, dtype=np.float64, count=3 * n_points)
+        return points
     
-    def get_lane_color(self, lane_type: str) -> str:
-        """Get color for lane type."""
-        colors = {
-            'VEHICLE': simplekml.Color.blue,
-            'BIKE': simplekml.Color.green,
-            'BUS': simplekml.Color.orange,
-            'PEDESTRIAN': simplekml.Color.red
-        }
-        return colors.get(lane_type, simplekml.Color.blue)
+    def _convert_points_to_gps(self, points: np.ndarray, lengths: List[int], city_name: Optional[CityName] = None) -> List[np.ndarray]:
+        """
+        Convert concatenated (N, 3) polyline points to per-polyline (M, 3) lon/lat/alt arrays.
+        
+        All points go through city_coords_to_wgs84 together, first for the scenario's resolved city (if given), then for the remaining
+        candidate cities. Only points without a plausible result move on to the next
+        city, and points no city resolves are dropped.
+        The returned arrays never alias the points, so a reused input buffer is safe.
+        """
+        if not len(points):
+            return [np.empty((0, 3)) for _ in lengths]
+        
+        if city_name is None:
+            city_order = CITY_PROBE_ORDER
+        else:
+            city_order = [city_name] + [city for city in CITY_PROBE_ORDER if city != city_name]
+        
+        lat_lon = np.zeros((len(points), 2))
+        unresolved = np.ones(len(points), dtype=bool)
+        
+        for city in city_order:
+            pending = np.flatnonzero(unresolved)
+            if not len(pending):
+                break
+            candidate = batch_convert(points[pending, :2], city)
+            plausible = (np.abs(candidate[:, 0]) > 0.1) & (np.abs(candidate[:, 1]) > 0.1)
+            lat_lon[pending[plausible]] = candidate[plausible]
+            unresolved[pending[plausible]] = False
+        
+        # Split the resolved points back per polyline, using how many of each polyline survived
+        resolved = ~unresolved
+        gps_points = np.column_stack((lat_lon[resolved, 1], lat_lon[resolved, 0], points[resolved, 2]))
+        resolved_before = np.concatenate(([0], np.cumsum(resolved)))
+        return np.split(gps_points, resolved_before[np.cumsum(lengths)[:-1]])
+
+# Scenarios handed to each pool worker per task
+SCENARIO_CHUNKSIZE = 32
+
+# Per-process processor (geofence, caches, coordinate buffer), built once by the pool initializer
+_worker_processor = None
+
+def init_scenario_worker(detroit_only, include_lanes, include_drivable, group_by_style=False):
+    """Executor initializer: build one OptimizedKMLProcessor per worker process, not one per task."""
+    global _worker_processor
+    _worker_processor = OptimizedKMLProcessor(detroit_only, include_lanes, include_drivable, group_by_style)
+
+def process_scenario_worker(scenario_batch):
+    """Worker function for parallel processing of a batch of (split, scenario_id, map_file, known_detroit) entries."""
+    result = _worker_processor.process_scenario_batch(scenario_batch)
+    result['features'] = pack_features(result['features'])
+    return result
+
+def pack_features(features: List[Tuple]) -> Tuple[List[Tuple], np.ndarray, np.ndarray]:
+    """
+    Pack feature tuples into (meta, coords, part_ends) for the trip back to the parent.
     
-    def get_lane_width(self, mark_type: str) -> int:
-        """Get width for lane marking type."""
-        widths = {
-            'SOLID_WHITE': 3,
-            'DASHED_WHITE': 2,
-            'SOLID_YELLOW': 3,
-            'DASHED_YELLOW': 2,
-            'DOUBLE_SOLID_YELLOW': 4,
-            'SOLID_DASH_YELLOW': 3,
-            'DASH_SOLID_YELLOW': 3,
-            'NONE': 1
-        }
-        return widths.get(mark_type, 1)
+    Every coordinate array of the batch is concatenated into one (N, 3) array, which pickles as a
+    single buffer instead of one ndarray object per feature; meta keeps
+    (kind, name, part_count, style_index, description) and part_ends the end row of each part.
+    """
+    meta = []
+    parts = []
+    for kind, name, coords, style_index, description in features:
+        if kind == 'multilinestring':
+            parts.extend(coords)
+            meta.append((kind, name, len(coords), style_index, description))
+        else:
+            parts.append(coords)
+            meta.append((kind, name, 1, style_index, description))
+    if not parts:
+        return meta, np.empty((0, 3)), np.empty(0, dtype=np.int64)
+    part_ends = np.cumsum([len(part) for part in parts])
+    return meta, np.concatenate(parts), part_ends
 
-def process_scenario_batch_worker(args):
-    """Worker function for parallel processing."""
-    batch_data, detroit_only, include_lanes, include_drivable = args
-    processor = OptimizedKMLProcessor(detroit_only, include_lanes, include_drivable)
-    return processor.process_scenario_batch(batch_data)
+def unpack_features(packed: Tuple[List[Tuple], np.ndarray, np.ndarray]):
+    """Yield (kind, name, coords, style_index, description) features from pack_features output."""
+    meta, coords, part_ends = packed
+    part_starts = np.concatenate(([0], part_ends[:-1])).tolist()
+    part_ends = part_ends.tolist()
+    part = 0
+    for kind, name, part_count, style_index, description in meta:
+        if kind == 'multilinestring':
+            feature_coords = [coords[part_starts[i]:part_ends[i]] for i in range(part, part + part_count)]
+        else:
+            feature_coords = coords[part_starts[part]:part_ends[part]]
+        part += part_count
+        yield kind, name, feature_coords, style_index, description
 
 class MotionForecastingSingleKMLGenerator:
     
-    def __init__(self, base_dir=MOTION_FORECASTING_BASE, detroit_only=False, include_lanes=True, include_drivable=False, max_workers=None):
+    def __init__(self, base_dir=MOTION_FORECASTING_BASE, detroit_only=False, include_lanes=True, include_drivable=False, max_workers=None, group_by_style=False):
         self.base_dir = Path(base_dir)
         self.detroit_only = detroit_only
         self.include_lanes = include_lanes
         self.include_drivable = include_drivable
+        self.group_by_style = group_by_style
         self.max_workers = max_workers or min(mp.cpu_count(), 8)  # Limit to 8 workers max
+        self._detroit_cache = None  # Opened by generate_all_kml_files in Detroit mode
         self.stats = {
             'lane_segments': 0,
             'pedestrian_crossings': 0,
@@ -363,84 +770,94 @@ class MotionForecastingSingleKMLGenerator:
             'DASH_SOLID_YELLOW': {'color': simplekml.Color.yellow, 'width': 3},
             'NONE': {'color': simplekml.Color.gray, 'width': 1}
         }
+        
+        # Shared style ids, one per STYLE_TABLE entry; each distinct style is written once in the header
+        self._style_ids = [
+            f"line_{color}_{width}" if kind == 'line' else f"area_{color}" for kind, color, width in STYLE_TABLE
+        ]
+
+    def _style_header(self) -> str:
+        """Return the shared <Style> blocks for every line and polygon style."""
+        blocks = {}
+        for style_id, (kind, color, width) in zip(self._style_ids, STYLE_TABLE):
+            if style_id not in blocks:
+                if kind == 'line':
+                    blocks[style_id] = _line_style(style_id, color, width)
+                else:
+                    blocks[style_id] = _polygon_style(style_id, color, simplekml.Color.darkblue, 2)
+        return ''.join(blocks.values())
+
+    def _split_filename(self, split: str) -> str:
+        """Return the output KMZ filename for a split."""
+        region_suffix = "detroit" if self.detroit_only else "all_regions"
+        data_types = []
+        if self.include_lanes:
+            data_types.append("lanes")
+        if self.include_drivable:
+            data_types.append("drivable")
+        data_suffix = "_".join(data_types)
+        return f"motion_forecasting_maps_{region_suffix}_{data_suffix}_{split}.kmz"
 
-    def create_split_kml(self, split: str) -> simplekml.Kml:
-        """Create single KML file for a specific split using parallel processing."""
+    def _write_batch_result(self, out: TextIO, result: Dict[str, Any], total_stats: Dict[str, int]) -> int:
+        """Write one worker batch result to the KML stream, merge its stats and decisions, and return its feature count."""
+        style_ids = self._style_ids
+        for kind, name, coords, style_index, description in unpack_features(result['features']):
+            if kind == 'linestring':
+                _emit_linestring(out, name, coords, style_ids[style_index], description)
+            elif kind == 'multilinestring':
+                _emit_multilinestring(out, name, coords, style_ids[style_index], description)
+            elif kind == 'polygon':
+                _emit_polygon(out, name, coords, style_ids[style_index], description)
+        for key in total_stats:
+            total_stats[key] += result['stats'][key]
+        if self._detroit_cache is not None:
+            for scenario_id, is_detroit in result['detroit_decisions'].items():
+                self._detroit_cache[f"{GEOFENCE_KEY}:{scenario_id}"] = is_detroit
+        return len(result['features'][0])
+    
+    def create_split_kml(self, split: str) -> Optional[Tuple[str, int]]:
+        """Stream a single KML file for a split and return (filename, feature count), or None if empty."""
         split_dir = self.base_dir / split
         if not split_dir.exists():
             return None
         
         print(f"Processing {split} split with {self.max_workers} workers...")
         
-        # Collect all scenario files
+        # Collect all scenario files (scandir reuses the directory entry type, no extra stat per entry).
+        # Map files are not stat'ed here; workers skip scenarios whose archive is missing when they open it.
         scenario_files = []
-        for scenario_dir in split_dir.iterdir():
-            if not scenario_dir.is_dir():
-                continue
-            
-            scenario_id = scenario_dir.name
-            map_file = scenario_dir / f"log_map_archive_{scenario_id}.json"
-            if map_file.exists():
-                scenario_files.append((split, scenario_id, map_file))
+        cached_rejects = 0
+        with os.scandir(split_dir) as entries:
+            for entry in entries:
+                if not entry.is_dir(follow_symlinks=False):
+                    continue
+                
+                scenario_id = entry.name
+                map_file = os.path.join(entry.path, f"log_map_archive_{scenario_id}.json")
+                known_detroit = self._detroit_cache.get(f"{GEOFENCE_KEY}:{scenario_id}") if self._detroit_cache is not None else None
+                if known_detroit is False:
+                    cached_rejects += 1
+                    continue
+                scenario_files.append((split, scenario_id, map_file, bool(known_detroit)))
+        
+        if cached_rejects:
+            print(f"Skipped {cached_rejects} scenarios cached as outside Detroit")
         
         if not scenario_files:
-            print(f"No map files found for {split} split")
+            print(f"No scenario directories found for {split} split")
             return None
         
-        print(f"Found {len(scenario_files)} scenarios to process")
-        
-        # Create batches for parallel processing
-        batch_size = max(1, len(scenario_files) // (self.max_workers * 4))  # 4 batches per worker
-        batches = []
-        for i in range(0, len(scenario_files), batch_size):
-            batch = scenario_files[i:i + batch_size]
-            batches.append(batch)
+        print(f"Found {len(scenario_files)} scenario directories to process")
         
-        print(f"Created {len(batches)} batches of ~{batch_size} scenarios each")
-        
-        # Process batches in parallel
-        all_features = []
+        # Process scenarios in parallel and stream each result straight into the KML
         total_stats = {
             'lane_segments': 0,
             'pedestrian_crossings': 0,
             'drivable_areas': 0,
             'scenarios_processed': 0
         }
+        feature_count = 0
         
-        start_time = time.time()
-        
-        with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
-            # Submit all batches
-            future_to_batch = {
-                executor.submit(process_scenario_batch_worker, (batch, self.detroit_only, self.include_lanes, self.include_drivable)): batch 
-                for batch in batches
-            }
-            
-            # Process completed batches with progress bar
-            with tqdm(total=len(batches), desc=f"Processing {split} batches") as pbar:
-                for future in as_completed(future_to_batch):
-                    try:
-                        result = future.result()
-                        all_features.extend(result['features'])
-                        
-                        # Update stats
-                        for key in total_stats:
-                            total_stats[key] += result['stats'][key]
-                        
-                        pbar.update(1)
-                        
-                        # Memory management
-                        if len(all_features) > 10000:
-                            gc.collect()
-                            
-                    except Exception as e:
-                        print(f"Error processing batch: {e}")
-                        pbar.update(1)
-        
-        processing_time = time.time() - start_time
-        print(f"Processed {split} in {processing_time:.1f} seconds ({len(scenario_files)/processing_time:.1f} scenarios/sec)")
-        
-        # Create KML file
         region_name = "Detroit" if self.detroit_only else "All Regions"
         data_types = []
         if self.include_lanes:
@@ -449,38 +866,57 @@ class MotionForecastingSingleKMLGenerator:
             data_types.append("Drivable Areas")
         data_type_str = "+".join(data_types)
         
-        kml = simplekml.Kml()
-        kml.name = f"Motion Forecasting HD Maps - {region_name} - {data_type_str} - {split.capitalize()}"
-        kml.description = f"Motion Forecasting HD Maps for {split} split ({region_name}, {data_type_str})"
-        
-        # Add features to KML
-        print(f"Adding {len(all_features)} features to KML...")
-        for feature in all_features:
-            if feature['type'] == 'linestring':
-                line = kml.newlinestring(
-                    name=feature['name'],
-                    coords=feature['coords']
-                )
-                line.style.linestyle.color = feature['color']
-                line.style.linestyle.width = feature['width']
-                line.description = feature['description']
-            elif feature['type'] == 'polygon':
-                polygon = kml.newpolygon(
-                    name=feature['name'],
-                    outerboundaryis=feature['coords']
-                )
-                polygon.style.polystyle.color = feature['color']
-                polygon.style.polystyle.outline = 1
-                polygon.style.linestyle.color = simplekml.Color.darkblue
-                polygon.style.linestyle.width = 2
-                polygon.description = feature['description']
+        output_file = self._split_filename(split)
+        start_time = time.time()
+        
+        try:
+            with _kml_stream(
+                output_file,
+                f"Motion Forecasting HD Maps - {region_name} - {data_type_str} - {split.capitalize()}",
+                f"Motion Forecasting HD Maps for {split} split ({region_name}, {data_type_str})"
+            ) as out:
+                out.write(self._style_header())
+                
+                with ProcessPoolExecutor(max_workers=self.max_workers, initializer=init_scenario_worker,
+                                         initargs=(self.detroit_only, self.include_lanes, self.include_drivable, self.group_by_style)) as executor:
+                    # Each worker call gets a whole batch so its reader thread can prefetch archives;
+                    # results are taken in submission order, so the written KML is deterministic across runs
+                    batches = [scenario_files[i:i + SCENARIO_CHUNKSIZE] for i in range(0, len(scenario_files), SCENARIO_CHUNKSIZE)]
+                    futures = deque(executor.submit(process_scenario_worker, batch) for batch in batches)
+                    with tqdm(total=len(batches), desc=f"Processing {split} scenario batches") as pbar:
+                        while futures:
+                            future = futures.popleft()  # Popped so each result is freed once written
+                            try:
+                                result = future.result()
+                            except BrokenProcessPool as e:
+                                print(f"Error: worker pool failed, stopping {split} after {pbar.n} of {len(batches)} batches: {e}")
+                                for pending in futures:
+                                    pending.cancel()
+                                break
+                            except Exception as e:
+                                print(f"Error processing batch: {e}")
+                                result = None
+                            pbar.update(1)
+                            if result is not None:
+                                feature_count += self._write_batch_result(out, result, total_stats)
+        except BaseException:
+            # Never leave a truncated document behind (e.g. on Ctrl-C or a failed write)
+            if os.path.exists(output_file):
+                os.remove(output_file)
+            raise
+        
+        processing_time = time.time() - start_time
+        print(f"Processed {split} in {processing_time:.1f} seconds ({len(scenario_files)/processing_time:.1f} scenarios/sec)")
         
         # Update global stats
         for key in self.stats:
             self.stats[key] += total_stats[key]
         
-        print(f"Completed {split}: {total_stats['scenarios_processed']} scenarios, {len(all_features)} features")
-        return kml if len(all_features) > 0 else None
+        print(f"Completed {split}: {total_stats['scenarios_processed']} scenarios, {feature_count} features")
+        if feature_count == 0:
+            os.remove(output_file)
+            return None
+        return output_file, feature_count
 
     def generate_all_kml_files(self):
         """Generate KML files for all splits using optimized processing."""
@@ -490,6 +926,7 @@ class MotionForecastingSingleKMLGenerator:
         print(f"Detroit filtering: {'Enabled' if self.detroit_only else 'Disabled'}")
         print(f"Include lanes: {'Yes' if self.include_lanes else 'No'}")
         print(f"Include drivable areas: {'Yes' if self.include_drivable else 'No'}")
+        print(f"Group lane boundaries by style: {'Yes' if self.group_by_style else 'No'}")
         print("=" * 60)
         
         self.stats = {
@@ -502,24 +939,22 @@ class MotionForecastingSingleKMLGenerator:
         total_files_generated = 0
         total_start_time = time.time()
         
-        for split in ['train', 'val', 'test']:
-            split_kml = self.create_split_kml(split)
-            
-            if split_kml:
-                region_suffix = "detroit" if self.detroit_only else "all_regions"
-                data_types = []
-                if self.include_lanes:
-                    data_types.append("lanes")
-                if self.include_drivable:
-                    data_types.append("drivable")
-                data_suffix = "_".join(data_types)
+        if self.detroit_only:
+            self._detroit_cache = shelve.open(str(self.base_dir / DETROIT_CACHE_FILE))
+        try:
+            for split in ['train', 'val', 'test']:
+                split_result = self.create_split_kml(split)
                 
-                filename = f"motion_forecasting_maps_{region_suffix}_{data_suffix}_{split}.kml"
-                split_kml.save(filename)
-                print(f"{split.capitalize()} KML saved: {filename} ({len(split_kml.features)} features)")
-                total_files_generated += 1
-            else:
-                print(f"No data found for {split} split")
+                if split_result:
+                    filename, feature_count = split_result
+                    print(f"{split.capitalize()} KMZ saved: {filename} ({feature_count} features)")
+                    total_files_generated += 1
+                else:
+                    print(f"No data found for {split} split")
+        finally:
+            if self._detroit_cache is not None:
+                self._detroit_cache.close()
+                self._detroit_cache = None
         
         total_time = time.time() - total_start_time
         print(f"\n" + "=" * 60)
@@ -530,7 +965,7 @@ class MotionForecastingSingleKMLGenerator:
             print(f"   Pedestrian crossings: {self.stats['pedestrian_crossings']}")
         if self.include_drivable:
             print(f"   Drivable areas: {self.stats['drivable_areas']}")
-        print(f"   KML files generated: {total_files_generated}")
+        print(f"   KMZ files generated: {total_files_generated}")
         print(f"   Average processing rate: {self.stats['scenarios_processed']/total_time:.1f} scenarios/sec")
 
 def main():
@@ -543,6 +978,8 @@ def main():
                        help="Select which map elements to include: 'lanes' for lane segments and pedestrian crossings, 'drivable' for drivable areas only (default: lanes)")
     parser.add_argument("--workers", type=int, default=None,
                        help="Number of parallel workers (default: auto-detect, max 8)")
+    parser.add_argument("--group-by-style", action="store_true",
+                       help="Merge each scenario's lane boundaries into one MultiGeometry placemark per lane/mark style (smaller KMZ, fewer placemarks)")
     
     args = parser.parse_args()
     
@@ -581,7 +1018,8 @@ def main():
         detroit_only=args.detroit_only,
         include_lanes=include_lanes,
         include_drivable=include_drivable,
-        max_workers=args.workers
+        max_workers=args.workers,
+        group_by_style=args.group_by_style
     )
     
     generator.generate_all_kml_files()